@@ -1,8 +1,11 @@
 ﻿__version__ = "0.0.1"
 
 from dmyplant2.support import cred
-from dmyplant2.dMyplant import MyPlant
+from dmyplant2.dMyplant import MyPlant, AsyncMyPlant
+from dmyplant2.dCache import ResponseCache
+from dmyplant2.dScheduler import RequestScheduler
 from dmyplant2.dValidation import Validation
 from dmyplant2.dEngine import Engine, EngineReadOnly
+from dmyplant2.dHistory import HistoryStore
 import dmyplant2.dReliability
 from dmyplant2.dPlot import demonstrated_Reliabillity_Plot, chart
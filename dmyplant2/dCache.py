@@ -0,0 +1,396 @@
+﻿import os
+import re
+import json
+import hashlib
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from urllib.parse import urlsplit, parse_qsl, urlencode
+from dmyplant2.dMyplant import epoch_ts
+from dmyplant2.support import FileLock
+
+# time to live in seconds for responses that may still change,
+# None .. never expires
+default_ttl = {
+    'asset': 3600,
+    'dataitem': 3600,
+    'history': 900,
+    'batchdata': 900,
+    'alarms': 900,
+    'other': 900
+}
+
+# names of the files a ResponseCache owns in its directory,
+# nothing else there is ever deleted
+_data_file = re.compile(r'^[0-9a-f]{64}\.json$')
+_temp_prefix = 'rc-'
+_temp_file = re.compile(r'^rc-.*\.tmp$')
+
+
+def endpoint(url) -> str:
+    """
+    classify a MyPlant url by its endpoint
+    returns one of 'asset', 'dataitem', 'history', 'batchdata', 'alarms', 'other'
+    """
+    path = urlsplit(url).path.rstrip('/')
+    if path.endswith('/history/batchdata'):
+        return 'batchdata'
+    if path.endswith('/history/alarms'):
+        return 'alarms'
+    if path.endswith('/history/data'):
+        return 'history'
+    if '/dataitem/' in path:
+        return 'dataitem'
+    if path.startswith('/asset'):
+        return 'asset'
+    return 'other'
+
+
+def normalize_url(url) -> str:
+    """url with sorted query parameters, equal queries give equal urls"""
+    parts = urlsplit(url)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return parts.path + ('?' + query if query else '')
+
+
+class ResponseCache(object):
+    """
+    Content addressed on-disk cache for MyPlant.fetchdata
+
+    Responses are stored as json files named by the sha256 of the
+    normalized url. Queries on a closed time window ('to' or 'timestamp'
+    in the past) never change and are kept forever, all other responses
+    expire after the ttl of their endpoint. The cache is bounded to
+    max_bytes, the least recently used entries are evicted first.
+
+    Several processes may share the directory: writers append their
+    entries to the log index.log under the lock file index.lock, every
+    instance reads only the lines added since it last looked. A cache
+    hit touches the data file, so the lru order is kept on disk as well.
+    Eviction goes down to 90% of max_bytes and compacts the log.
+
+    e.g.: mp = MyPlant(cache=ResponseCache())
+    """
+
+    def __init__(self, path=None, max_bytes=512 * 1024 * 1024, ttl=None, settle=3600):
+        """ResponseCache Constructor
+            path      .. cache directory, default ./data/cache
+            max_bytes .. size limit of the cache
+            ttl       .. dict endpoint: seconds, updates default_ttl
+            settle    .. seconds a closed time window must lie in the past
+                         before the response is kept forever"""
+        self._path = path if path else os.getcwd() + '/data/cache'
+        os.makedirs(self._path, exist_ok=True)
+        self._logfile = os.path.join(self._path, 'index.log')
+        self._max_bytes = max_bytes
+        self._ttl = dict(default_ttl)
+        self._ttl.update(ttl or {})
+        self._settle = settle
+        self._lock = threading.RLock()
+        self._flock = FileLock(os.path.join(self._path, 'index.lock'))
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        # in memory state of index.log: entries, their total size,
+        # the inode of the log, bytes and lines read so far
+        self._index = {}
+        self._size = 0
+        self._log_ino = None
+        self._log_pos = 0
+        self._log_lines = 0
+        with self._lock, self._flock:
+            self._cleanup()
+
+    def _sync(self):
+        """
+        internal, caller holds self._lock
+        apply the lines other instances appended to index.log since
+        the last call, start over if the log was compacted
+        """
+        try:
+            handle = open(self._logfile, 'rb')
+        except FileNotFoundError:
+            return
+        with handle:
+            st = os.fstat(handle.fileno())
+            if st.st_ino != self._log_ino or st.st_size < self._log_pos:
+                self._index, self._size = {}, 0
+                self._log_ino, self._log_pos, self._log_lines = st.st_ino, 0, 0
+            if st.st_size == self._log_pos:
+                return
+            handle.seek(self._log_pos)
+            chunk = handle.read(st.st_size - self._log_pos)
+        # a line without newline is still being written
+        chunk = chunk[:chunk.rfind(b'\n') + 1]
+        self._log_pos += len(chunk)
+        for line in chunk.splitlines():
+            self._log_lines += 1
+            try:
+                self._apply(json.loads(line))
+            except (ValueError, KeyError, TypeError):
+                logging.warning(f'skip corrupt line in {self._logfile}')
+
+    def _apply(self, rec):
+        """internal, apply one log record to the in memory index"""
+        old = self._index.pop(rec['key'], None)
+        if old is not None:
+            self._size -= old['size']
+        if not rec.get('removed', False):
+            self._index[rec['key']] = rec
+            self._size += rec['size']
+
+    def _append(self, records):
+        """internal, append records to index.log, caller holds self._lock and self._flock"""
+        self._sync()
+        with open(self._logfile, 'ab') as handle:
+            handle.write(b''.join(json.dumps(rec).encode('utf-8') + b'\n' for rec in records))
+        self._sync()
+
+    def _compact(self):
+        """
+        internal, rewrite index.log with the live entries only,
+        caller holds self._lock and self._flock
+        """
+        self._sync()
+        self._write(self._logfile, ''.join(json.dumps(rec) + '\n' for rec in self._index.values()))
+        self._log_ino = None
+        self._sync()
+
+    def _cleanup(self):
+        """
+        internal, caller holds self._lock and self._flock
+        drop entries without data file, data files without entry
+        and temp files left by an interrupted writer.
+        Only files named like cache files are touched.
+        """
+        self._sync()
+        gone = [k for k in self._index if not os.path.exists(self._file(k))]
+        if gone:
+            self._append([{'key': k, 'removed': True} for k in gone])
+        old = datetime.now().timestamp() - 3600
+        for fname in os.listdir(self._path):
+            full = os.path.join(self._path, fname)
+            if _data_file.match(fname) and fname[:-5] not in self._index:
+                os.remove(full)
+            elif _temp_file.match(fname) and os.path.getmtime(full) < old:
+                os.remove(full)
+        if self._log_lines > 2 * len(self._index) + 1024:
+            self._compact()
+
+    def _entry(self, key):
+        """
+        internal, caller holds self._lock
+        live index entry of key, reads the lines other processes
+        appended if the entry is missing or expired
+        """
+        now = datetime.now().timestamp()
+        entry = self._index.get(key, None)
+        if entry is None or (entry['expires'] is not None and entry['expires'] <= now):
+            self._sync()
+            entry = self._index.get(key, None)
+        if entry is not None and (entry['expires'] is None or entry['expires'] > now):
+            return entry
+        return None
+
+    def _atime(self, key):
+        """internal, last access of key, the mtime of its data file"""
+        try:
+            return os.path.getmtime(self._file(key))
+        except FileNotFoundError:
+            return self._index[key]['atime']
+
+    def _write(self, fname, text):
+        """internal, write to a temp file and rename"""
+        fd, tmp = tempfile.mkstemp(dir=self._path, prefix=_temp_prefix, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as handle:
+                handle.write(text)
+            os.replace(tmp, fname)
+        except:
+            os.remove(tmp)
+            raise
+
+    def _file(self, key):
+        return os.path.join(self._path, key + '.json')
+
+    @staticmethod
+    def key(url) -> str:
+        """cache key of url"""
+        return hashlib.sha256(normalize_url(url).encode('utf-8')).hexdigest()
+
+    def _expires(self, url):
+        """
+        internal
+        epoch timestamp when the response of url expires,
+        None for closed historical time windows
+        """
+        now = datetime.now().timestamp()
+        query = dict(parse_qsl(urlsplit(url).query))
+        end = query.get('to', query.get('timestamp', None))
+        if end and 'limit' not in query:
+            try:
+                if epoch_ts(float(end)) < now - self._settle:
+                    return None
+            except ValueError:
+                pass
+        return now + self._ttl.get(endpoint(url), self._ttl['other'])
+
+    def get(self, url):
+        """cached data for url or None"""
+        key = self.key(url)
+        with self._lock:
+            entry = self._entry(key)
+            if entry is not None:
+                try:
+                    with open(self._file(key), 'r', encoding='utf-8') as handle:
+                        data = json.load(handle)
+                    self._touch(key, entry)
+                    self._hits += 1
+                    return data
+                except FileNotFoundError:
+                    # evicted by another process
+                    self._sync()
+                except ValueError:
+                    logging.warning(f'cache entry for {url} is unreadable')
+                    with self._flock:
+                        self._remove([key])
+            self._misses += 1
+            return None
+
+    def _touch(self, key, entry):
+        """internal, record an access, on disk as the mtime of the data file"""
+        now = datetime.now().timestamp()
+        entry['atime'] = now
+        try:
+            os.utime(self._file(key), (now, now))
+        except FileNotFoundError:
+            pass
+
+    def put(self, url, data):
+        """store data for url"""
+        key = self.key(url)
+        text = json.dumps(data)
+        with self._lock, self._flock:
+            self._write(self._file(key), text)
+            self._commit(key, url, len(text))
+
+    def _commit(self, key, url, size):
+        """
+        internal, index a stored response,
+        caller holds self._lock and self._flock
+        """
+        self._append([{
+            'key': key,
+            'url': normalize_url(url),
+            'size': size,
+            'atime': datetime.now().timestamp(),
+            'expires': self._expires(url)
+        }])
+        if self._size > self._max_bytes:
+            self._evict()
+        elif self._log_lines > 2 * len(self._index) + 1024:
+            self._compact()
+
+    def open(self, url):
+        """
+        binary file object with the cached raw json of url or None,
+        for streaming decoders, the caller closes the file
+        """
+        key = self.key(url)
+        with self._lock:
+            entry = self._entry(key)
+            if entry is not None:
+                try:
+                    handle = open(self._file(key), 'rb')
+                    self._touch(key, entry)
+                    self._hits += 1
+                    return handle
+                except FileNotFoundError:
+                    # evicted by another process
+                    self._sync()
+            self._misses += 1
+            return None
+
+    @contextmanager
+    def spool(self, url):
+        """
+        binary file object to write the raw json of url into,
+        stored in the cache when the with block ends without error
+        """
+        key = self.key(url)
+        fd, tmp = tempfile.mkstemp(dir=self._path, prefix=_temp_prefix, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as handle:
+                yield handle
+                size = handle.tell()
+            with self._lock, self._flock:
+                os.replace(tmp, self._file(key))
+                self._commit(key, url, size)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def _remove(self, keys):
+        """
+        internal, drop keys from index and disk,
+        caller holds self._lock and self._flock
+        """
+        self._append([{'key': key, 'removed': True} for key in keys])
+        for key in keys:
+            try:
+                os.remove(self._file(key))
+            except FileNotFoundError:
+                pass
+
+    def _evict(self):
+        """
+        internal, drop expired entries, then lru entries down to 90%
+        of max_bytes, and compact the log,
+        caller holds self._lock and self._flock
+        """
+        now = datetime.now().timestamp()
+        keys = [k for k, v in self._index.items() if v['expires'] is not None and v['expires'] <= now]
+        size = self._size - sum(self._index[k]['size'] for k in keys)
+        if size > self._max_bytes:
+            expired = set(keys)
+            for key in sorted((k for k in self._index if k not in expired), key=self._atime):
+                size -= self._index[key]['size']
+                keys.append(key)
+                self._evictions += 1
+                if size <= 0.9 * self._max_bytes:
+                    break
+        self._remove(keys)
+        self._compact()
+
+    def clear(self):
+        """remove all cached responses"""
+        with self._lock, self._flock:
+            self._sync()
+            self._remove(list(self._index))
+            self._compact()
+
+    @property
+    def size(self):
+        """size of all cached responses in bytes"""
+        return self._size
+
+    @property
+    def stats(self):
+        """hit/miss counters"""
+        with self._lock:
+            self._sync()
+        return {
+            'hits': self._hits,
+            'misses': self._misses,
+            'evictions': self._evictions,
+            'entries': len(self._index),
+            'bytes': self.size
+        }
+
+    @property
+    def path(self):
+        """the cache directory"""
+        return self._path
@@ -3,19 +3,83 @@ import math
 from pprint import pprint as pp
 import pandas as pd
 import numpy as np
-from dmyplant2.dMyplant import epoch_ts, mp_ts
+from dmyplant2.dMyplant import epoch_ts, mp_ts, AssetIndex, MyPlantException
+from dmyplant2.dStream import BatchDataDecoder
+from dmyplant2.dHistory import HistoryStore
+from dmyplant2.support import FileLock, atomic_write
 import sys
 import os
 import pickle
 import logging
 import json
+import copy
+import time
+import shutil
+import tempfile
+import threading
+import contextvars
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
 import arrow
 
 
+# version of the on-disk engine snapshot, bump on incompatible changes
+_cache_version = 1
+
+
+def _json_default(obj):
+    """internal, json encoder for the engine snapshot"""
+    if isinstance(obj, (pd.Timestamp, datetime)):
+        return {'__ts__': obj.isoformat()}
+    if isinstance(obj, np.integer):
+        return int(obj)
+    if isinstance(obj, np.floating):
+        return float(obj)
+    if isinstance(obj, np.bool_):
+        return bool(obj)
+    return str(obj)
+
+
+def _json_hook(d):
+    """internal, json decoder for the engine snapshot"""
+    if len(d) == 1 and '__ts__' in d:
+        return pd.Timestamp(d['__ts__'])
+    return d
+
+
+# background workers refreshing expired engines, see Engine(stale=True)
+_refresh_workers = 4
+_refresh_pool = None
+_refresh_pool_lock = threading.Lock()
+
+
+def _refresher():
+    """internal, shared thread pool for background refreshes"""
+    global _refresh_pool
+    with _refresh_pool_lock:
+        if _refresh_pool is None:
+            _refresh_pool = ThreadPoolExecutor(
+                max_workers=_refresh_workers, thread_name_prefix='dmyplant-refresh')
+        return _refresh_pool
+
+
 class Engine(object):
     """ dmyplant Engine Class
         mp  .. MyPlant Object
         eng .. Pandas Validation Input DataFrame
+
+        Engines are cached in ./data as
+        <sn>.json        .. small versioned snapshot: last server contact,
+                            validation definition and the summary items
+        <sn>_asset.json  .. the full asset, loaded on first access
+        <sn>.lock        .. held by the process writing the engine files
+
+        The files are replaced atomically, readers never block and
+        never see a partial file. A writer re-checks after taking the
+        lock whether another process has refreshed the engine meanwhile.
+
+        with stale=True an expired snapshot is served immediately
+        and refreshed from MyPlant in a background worker
     """
     _sn = 0
     _picklefile = ''
@@ -24,48 +88,242 @@ class Engine(object):
     _k = None
     _P = 0.0
     _d = {}
-
-    def __init__(self, mp, eng):
+    _asset = None
+    _asset_dirty = False
+    _refresh = None
+    _snap_state = None
+    _summary = {}
+
+    # asset items stored in the snapshot, available without loading the asset
+    _summary_items = {
+        'nokey': ['serialNumber', 'status', 'id', 'model'],
+        'properties': ['Engine Series', 'Engine Version', 'Engine Type', 'IB Unit Commissioning Date',
+                       'Design Number', 'Engine ID', 'IB Control Software', 'IB Item Description Engine',
+                       'IB Project Name'],
+        'dataItems': ['Count_OpHour', 'Count_Start', 'Power_PowerNominal', 'Para_Speed_Nominal',
+                      'halio_power_fact_cos_phi', 'RMD_ListBuffMAvgOilConsume_OilConsumption']}
+
+    def __init__(self, mp, eng, stale=False):
         """ Engine Constructor
-            load Instance from Pickle File or
+            load Instance from the cache files or
             load Instance Data from Myplant
-            if Myplant Cache Time is passed"""
+            if Myplant Cache Time is passed
+            stale .. serve an expired cache and refresh in the background"""
 
         # take engine Myplant Serial Number from Validation Definition
         self._mp = mp
         self._eng = eng
         self._sn = str(eng['serialNumber'])
-        fname = os.getcwd() + '/data/' + self._sn
-        self._picklefile = fname + '.pkl'    # load persitant data
-        self._lastcontact = fname + '_lastcontact.pkl'
-        try:
-            with open(self._lastcontact, 'rb') as handle:
-                self._last_fetch_date = pickle.load(handle)
-        except:
-            pass
-        try:
-            # fetch data from Myplant only on conditions below
-            if self._cache_expired()['bool'] or (not os.path.exists(self._picklefile)):
-                local_asset = self._mp.asset_data(self._sn)
+        self._lock = threading.RLock()
+        self._set_filenames()
+        self._load_snapshot() or self._load_legacy()
+        cached = os.path.exists(self._assetfile) or self._asset is not None
+        expired = self._cache_expired()['bool']
+        refresh = stale and cached and expired
+        fetch = not refresh and (expired or not cached)
+        with self._flock if fetch else nullcontext():
+            try:
+                # fetch data from Myplant only on conditions below
+                if refresh:
+                    logging.debug(
+                        f"{eng['Validation Engine']}, serve cache of {self._sn}, refresh in background")
+                elif fetch and self._adopt_newer() and not self._cache_expired()['bool']:
+                    logging.debug(
+                        f"{eng['Validation Engine']}, Engine Data refreshed by another process")
+                elif fetch:
+                    # _last_fetch_date is now, do not take an older asset from the response cache
+                    local_asset = self._mp.asset_data(self._sn, cache=False)
+                    logging.debug(
+                        f"{eng['Validation Engine']}, Engine Data fetched from Myplant")
+                    self.asset = self._restructure(local_asset)
+                    self._last_fetch_date = epoch_ts(datetime.now().timestamp())
+                else:
+                    logging.debug(
+                        f"{__name__}: in cache mode, load data from {self._sn}.json")
+            finally:
                 logging.debug(
-                    f"{eng['Validation Engine']}, Engine Data fetched from Myplant")
-                self.asset = self._restructure(local_asset)
-                self._last_fetch_date = epoch_ts(datetime.now().timestamp())
+                    f"Initialize Engine Object, SerialNumber: {self._sn}")
+                self._d = self._engine_data(eng)
+                self._set_oph_parameter()
+                self._save()
+        if refresh:
+            self.refresh(wait=False)
+
+    def refresh(self, wait=True):
+        """
+        fetch the asset from MyPlant and swap it in,
+        wait=False returns immediately, the fetch runs in a background
+        worker; a refresh already running is not started again.
+        returns the concurrent.futures.Future of the refresh
+        """
+        with self._lock:
+            if self._refresh is None or self._refresh.done():
+                self._refresh = _refresher().submit(
+                    contextvars.copy_context().run, self._do_refresh)
+            future = self._refresh
+        if wait:
+            future.result()
+        return future
+
+    def _do_refresh(self):
+        """
+        internal
+        the new state is built on a shallow copy of the engine and
+        swapped in with one dict update, readers see either the old
+        or the new data. On failure the old data is kept.
+        """
+        with self._flock:
+            shadow = copy.copy(self)
+            if shadow._adopt_newer() and not shadow._cache_expired()['bool']:
+                logging.debug(f"{self._sn} refreshed by another process")
             else:
-                with open(self._picklefile, 'rb') as handle:
-                    self.__dict__ = pickle.load(handle)
+                try:
+                    local_asset = self._mp.asset_data(self._sn, cache=False)
+                except Exception as err:
+                    logging.error(f"{self._sn} background refresh failed: {err}")
+                    raise
+                if local_asset is None:
+                    logging.error(f"{self._sn} background refresh failed, keep cached data.")
+                    raise MyPlantException(f"{self._sn}: no asset data received")
+                shadow.asset = self._restructure(local_asset)
+                shadow._last_fetch_date = epoch_ts(datetime.now().timestamp())
+                logging.debug(f"{self._sn} refreshed from Myplant")
+            shadow._d = shadow._engine_data(self._eng)
+            shadow._set_oph_parameter()
+            new = {k: v for k, v in shadow.__dict__.items() if k not in ('_lock', '_refresh')}
+            with self._lock:
+                self.__dict__.update(new)
+                self._save()
+
+    @property
+    def refreshing(self):
+        """True while a background refresh is running"""
+        return self._refresh is not None and not self._refresh.done()
+
+    def wait_refresh(self, timeout=None):
+        """
+        block until a running background refresh has finished,
+        returns False if it failed or timed out
+        """
+        future = self._refresh
+        if future is None:
+            return True
+        try:
+            future.result(timeout=timeout)
+            return True
+        except Exception:
+            return False
+
+    @property
+    def age(self):
+        """seconds since the engine data was fetched from MyPlant"""
+        return self.time_since_last_server_contact
+
+    def _set_filenames(self):
+        """
+        internal
+        cache file names for self._sn
+        """
+        fname = os.getcwd() + '/data/' + self._sn
+        self._cachefile = fname + '.json'
+        self._assetfile = fname + '_asset.json'
+        self._picklefile = fname + '.pkl'   # cache format up to version 0.0.1
+        self._flock = FileLock(fname + '.lock')
+
+    def _record_io(self, endpoint, start, size):
+        """
+        internal
+        report file io to the MyPlant metrics, if there is a MyPlant object
+        """
+        mp = self.__dict__.get('_mp', None)
+        if mp is not None:
+            mp.metrics.record('io', endpoint, latency=time.perf_counter() - start,
+                              bytes=size)
+
+    def _load_snapshot(self, apply=True):
+        """
+        internal
+        load the engine snapshot, returns the snapshot dict
+        or None if there is no valid snapshot
+        apply=False only reads the snapshot
+        """
+        try:
+            start = time.perf_counter()
+            with open(self._cachefile, 'r', encoding='utf-8') as handle:
+                snap = json.load(handle, object_hook=_json_hook)
+                size = handle.tell()
         except FileNotFoundError:
+            return None
+        except ValueError:
+            logging.error(f"{self._cachefile} is corrupt, ignored.")
+            return None
+        if snap.get('version', None) != _cache_version:
             logging.debug(
-                f"{self._picklefile} not found, fetch Data from MyPlant Server")
-        else:
-            logging.debug(
-                f"{__name__}: in cache mode, load data from {self._sn}.pkl")
-        finally:
-            logging.debug(
-                f"Initialize Engine Object, SerialNumber: {self._sn}")
-            self._d = self._engine_data(eng)
-            self._set_oph_parameter()
-            self._save()
+                f"{self._cachefile} has version {snap.get('version', None)}, ignored.")
+            return None
+        self._record_io('snapshot/load', start, size)
+        if apply:
+            self._last_fetch_date = snap['last_fetch_date']
+            self._summary = snap['summary']
+            self._snap_state = self._snapshot_state(snap['last_fetch_date'], snap['eng'])
+        return snap
+
+    @staticmethod
+    def _snapshot_state(last_fetch_date, eng):
+        """internal, what the snapshot file holds, to skip needless writes"""
+        return (last_fetch_date, json.dumps(eng, default=_json_default, sort_keys=True))
+
+    def _adopt_newer(self):
+        """
+        internal, caller holds self._flock
+        take over a snapshot another process has written since this
+        engine was loaded, returns True if there was a newer one
+        """
+        snap = self._load_snapshot(apply=False)
+        if (snap is None or not os.path.exists(self._assetfile) or
+                snap['last_fetch_date'] <= self.__dict__.get('_last_fetch_date', 0.0)):
+            return False
+        self._load_snapshot()
+        self._asset = None
+        self._asset_dirty = False
+        return True
+
+    def _load_legacy(self):
+        """
+        internal
+        migrate the pickled Engine of previous versions,
+        the next _save writes the new format
+        """
+        try:
+            with open(self._picklefile, 'rb') as handle:
+                legacy = pickle.load(handle)
+            self._last_fetch_date = legacy['_last_fetch_date']
+            self.asset = legacy['asset']
+            logging.debug(f"{self._picklefile} migrated to {self._cachefile}")
+            return legacy
+        except FileNotFoundError:
+            return None
+        except Exception as err:
+            logging.debug(f"{self._picklefile} not migrated: {err}")
+            return None
+
+    @property
+    def asset(self):
+        """
+        the full MyPlant asset, loaded from the cache on first access
+        """
+        if self._asset is None:
+            start = time.perf_counter()
+            with open(self._assetfile, 'r', encoding='utf-8') as handle:
+                self._asset = json.load(handle)
+                size = handle.tell()
+            self._record_io('asset/load', start, size)
+        return self._asset
+
+    @asset.setter
+    def asset(self, value):
+        self._asset = value
+        self._asset_dirty = True
 
     def __str__(self):
         return f"{self._sn} {self._d['Engine ID']} {self.Name[:20] + (self.Name[20:] and ' ..'):23s}"
@@ -94,10 +352,9 @@ class Engine(object):
         Restructure Asset Data, add Variable
         Item names as dict key in dataItems & Properties
         """
-        local_asset['properties'] = {
-            p['name']: p for p in local_asset['properties']}
-        local_asset['dataItems'] = {
-            d['name']: d for d in local_asset['dataItems']}
+        ai = AssetIndex(local_asset)
+        local_asset['properties'] = dict(ai.items('properties'))
+        local_asset['dataItems'] = dict(ai.items('dataItems'))
         return local_asset
 
     def _set_oph_parameter(self):
@@ -117,25 +374,31 @@ class Engine(object):
         self._k2 = float(self.oph_parts /
                          (self.now_ts - self._valstart_ts))
 
+    @staticmethod
+    def _oph_line(k, valstart_ts, ts):
+        """
+        internal
+        oph line k * (ts - valstart_ts), clipped at 0.0
+        float for a scalar ts, np.array for an array of timestamps
+        """
+        y = np.maximum(k * (np.asarray(ts, dtype=np.float64) - valstart_ts), 0.0)
+        return float(y) if y.ndim == 0 else y
+
     def oph(self, ts):
         """
         linear inter- and extrapolation of oph(t)
-        t -> epoch timestamp
+        t -> epoch timestamp or array of epoch timestamps
         """
-        y = self._k * (ts - self._valstart_ts)
-        y = y if y > 0.0 else 0.0
-        return y
+        return self._oph_line(self._k, self._valstart_ts, ts)
 
     def oph2(self, ts):
         """
         linear inter- and extrapolation of oph2(t)
-        t -> epoch timestamp
+        t -> epoch timestamp or array of epoch timestamps
         uses different parameter calculation method,
         see _set_oph_parameter function
         """
-        y = self._k2 * (ts - self._valstart_ts)
-        y = y if y > 0.0 else 0.0
-        return y
+        return self._oph_line(self._k2, self._valstart_ts, ts)
 
     def _engine_data(self, eng) -> dict:
         """
@@ -175,21 +438,50 @@ class Engine(object):
     def _save(self):
         """
         internal
-        Persistant data storage to Pickle File
-        """
-        try:
-            with open(self._lastcontact, 'wb') as handle:
-                pickle.dump(self._last_fetch_date, handle, protocol=4)
-        except FileNotFoundError:
-            errortext = f'File {self._lastcontact} not found.'
-            logging.error(errortext)
-        try:
-            with open(self._picklefile, 'wb') as handle:
-                pickle.dump(self.__dict__, handle, protocol=4)
-        except FileNotFoundError:
-            errortext = f'File {self._picklefile} not found.'
-            logging.error(errortext)
-            # raise Exception(errortext)
+        Persistant data storage to the cache files,
+        the asset only if it was fetched
+        """
+        last_fetch_date = self.__dict__.get('_last_fetch_date', 0.0)
+        state = self._snapshot_state(last_fetch_date, self._eng)
+        if not self._asset_dirty and state == self._snap_state:
+            return      # the files are up to date, nothing to write
+        with self._flock:
+            if self._asset_dirty:
+                self._summary = {key: {item: self.get_data(key, item) for item in items}
+                                 for key, items in self._summary_items.items()}
+                try:
+                    start = time.perf_counter()
+                    with atomic_write(self._assetfile) as handle:
+                        json.dump(self._asset, handle, default=_json_default)
+                        size = handle.tell()
+                    self._asset_dirty = False
+                    self._record_io('asset/save', start, size)
+                except FileNotFoundError:
+                    errortext = f'File {self._assetfile} not found.'
+                    logging.error(errortext)
+            else:
+                disk = self._load_snapshot(apply=False)
+                if disk is not None and disk['last_fetch_date'] > last_fetch_date:
+                    # another process has refreshed the engine, keep its snapshot
+                    return
+            snap = {
+                'version': _cache_version,
+                'serialNumber': self._sn,
+                'last_fetch_date': last_fetch_date,
+                'eng': self._eng,
+                'summary': self._summary
+            }
+            try:
+                start = time.perf_counter()
+                with atomic_write(self._cachefile) as handle:
+                    json.dump(snap, handle, default=_json_default)
+                    size = handle.tell()
+                self._snap_state = state
+                self._record_io('snapshot/save', start, size)
+            except FileNotFoundError:
+                errortext = f'File {self._cachefile} not found.'
+                logging.error(errortext)
+                # raise Exception(errortext)
 
     def get_data(self, key, item):
         """
@@ -201,6 +493,11 @@ class Engine(object):
 
         e.g.: oph = e.get_data('dataItms','Count_OpHour')
         """
+        if self._asset is None:
+            # answer from the snapshot without loading the asset
+            summary = self._summary.get(key, {})
+            if item in summary:
+                return summary[item]
         return self.asset.get(item, None) if key == 'nokey' else self.asset[key].setdefault(item, {'value': None})['value']
 
     def get_property(self, item):
@@ -232,14 +529,61 @@ class Engine(object):
             res = None
         return res
 
-    def batch_hist_dataItem(self, itemId, p_from, p_to, timeCycle=3600):
+    @staticmethod
+    def _split_windows(p_from, p_to, timeCycle, max_rows):
+        """
+        internal
+        split p_from .. p_to [s] in windows of at most max_rows time cycles,
+        neighbour windows share their boundary timestamp
+        """
+        span = max(int(max_rows) - 1, 1) * int(timeCycle)
+        windows = []
+        start = p_from
+        while True:
+            end = min(start + span, p_to)
+            windows.append((start, end))
+            if end >= p_to:
+                return windows
+            start = end
+
+    @staticmethod
+    def _download_windows(fetch, windows, key, max_workers):
+        """
+        internal
+        call fetch(p_from, p_to) for all windows in parallel,
+        concat the DataFrames in time order and drop the
+        duplicates at the window boundaries
+        returns None if a window failed
+        """
+        # the windows run in the caller's context, e.g. its scheduler priority
+        with ThreadPoolExecutor(max_workers=max_workers) as ex:
+            futures = [ex.submit(contextvars.copy_context().run, fetch, *w) for w in windows]
+            dfs = [f.result() for f in futures]
+        if any(df is None for df in dfs):
+            logging.error(f'{sum(df is None for df in dfs)} of {len(dfs)} windows failed.')
+            return None
+        df = pd.concat(dfs, ignore_index=True)
+        return df.drop_duplicates(subset=key, keep='first').reset_index(drop=True)
+
+    def batch_hist_dataItem(self, itemId, p_from, p_to, timeCycle=3600, max_points=100000, max_workers=4):
         """
         Get np.array of dataItem history
         dataItemId  int64   Id of the DataItem to query.
         p_from      int64   timestamp start timestamp.
         p_to        int64   timestamp stop timestamp.
         timeCycle   int64   interval in seconds.
-        """
+        max_points  int64   longer ranges are split in windows of max_points,
+                            None .. no split
+        max_workers int64   windows downloaded in parallel
+        """
+        if max_points:
+            windows = self._split_windows(
+                epoch_ts(p_from), epoch_ts(p_to), timeCycle, max_points)
+            if len(windows) > 1:
+                return self._download_windows(
+                    lambda f, t: self.batch_hist_dataItem(
+                        itemId, f, t, timeCycle=timeCycle, max_points=None),
+                    windows, 'timestamp', max_workers)
         try:
             res = self._mp.history_dataItem(
                 self.id, itemId, mp_ts(p_from), mp_ts(p_to), timeCycle)
@@ -250,7 +594,8 @@ class Engine(object):
             pass
 
     def batch_hist_dataItems(self, itemIds={161: 'CountOph'}, p_limit=None, p_from=None, p_to=None, timeCycle=86400,
-                             assetType='J-Engine', includeMinMax='false', forceDownSampling='false'):
+                             assetType='J-Engine', includeMinMax='false', forceDownSampling='false', stream=True,
+                             max_points=100000, max_workers=4):
         """
         Get pandas dataFrame of dataItems history, either limit or From & to are required
         dataItemIds         dict   e.g. {161: 'CountOph'}, dict of dataItems to query.
@@ -261,15 +606,33 @@ class Engine(object):
         assetType           string default 'J-Engine'
         includeMinMax       string 'false'
         forceDownSampling   string 'false'
-        """
+        stream              bool   decode the response row by row into
+                                   numpy arrays, keeps peak memory low
+        max_points          int64  from .. to ranges with more points (rows x dataItems)
+                                   are split in windows, None .. no split
+        max_workers         int64  windows downloaded in parallel
+        """
+        if max_points and not p_limit and p_from and p_to:
+            windows = self._split_windows(arrow.get(p_from).timestamp, arrow.get(p_to).timestamp,
+                                          timeCycle, max(max_points // len(itemIds), 1))
+            if len(windows) > 1:
+                return self._download_windows(
+                    lambda f, t: self.batch_hist_dataItems(
+                        itemIds, p_from=f, p_to=t, timeCycle=timeCycle, assetType=assetType,
+                        includeMinMax=includeMinMax, forceDownSampling=forceDownSampling,
+                        stream=stream, max_points=None),
+                    windows, 'time', max_workers)
         try:
             tt = r""
             if p_limit:
                 tt = r"&limit=" + str(p_limit)
+                expected = int(p_limit)
             else:
                 if p_from and p_to:
                     tt = r'&from=' + str(arrow.get(p_from).timestamp * 1000) + \
                         r'&to=' + str(arrow.get(p_to).timestamp * 1000)
+                    expected = (arrow.get(p_to).timestamp -
+                                arrow.get(p_from).timestamp) // int(timeCycle) + 1
                 else:
                     raise Exception(
                         r"batch_hist_dataItems, invalid Parameters")
@@ -291,6 +654,12 @@ class Engine(object):
                 r'&includeMinMax=' + str(tincludeMinMax) + \
                 r'&forceDownSampling=' + str(tforceDownSampling)
 
+            if stream:
+                # decode straight into numpy arrays while downloading
+                dec = self._mp.fetchstream(
+                    url, BatchDataDecoder(expected=expected))
+                return dec.frame(tdef) if dec is not None else None
+
             # fetch data from myplant ....
             data = self._mp.fetchdata(url)
 
@@ -306,6 +675,43 @@ class Engine(object):
         except:
             raise
 
+    def sync_hist_dataItems(self, itemIds={161: 'CountOph'}, p_from=None, p_to=None, timeCycle=86400, store=None):
+        """
+        Get pandas dataFrame of dataItems history via a local HistoryStore,
+        only time ranges not downloaded before are fetched from Myplant
+        dataItemIds         dict   e.g. {161: 'CountOph'}, dict of dataItems to query.
+        p_from              string from iso date or timestamp,
+        p_to                string stop iso date or timestamp, default now.
+        timeCycle           int64  interval in seconds.
+        store               dHistory.HistoryStore, default ./data/history
+        """
+        store = store if store is not None else HistoryStore()
+        now = int(datetime.now().timestamp() * 1000)
+        t_from = arrow.get(p_from).timestamp * 1000
+        t_to = min(arrow.get(p_to).timestamp * 1000, now) if p_to else now
+
+        # group the dataItems by missing interval, one request per interval
+        gaps = {}
+        for itemId in itemIds:
+            for gap in store.missing(self._sn, itemId, timeCycle, t_from, t_to):
+                gaps.setdefault(gap, []).append(itemId)
+
+        for (g_from, g_to), items in sorted(gaps.items()):
+            logging.debug(
+                f"{self._sn} sync {items} {datetime.fromtimestamp(g_from / 1000)} .. {datetime.fromtimestamp(g_to / 1000)}")
+            tdef = {i: itemIds[i] for i in items}
+            df = self.batch_hist_dataItems(
+                tdef, p_from=g_from / 1000.0, p_to=g_to / 1000.0, timeCycle=timeCycle)
+            if df is None:
+                continue
+            # the last cycle before now may still change, fetch it again next time
+            covered_to = g_to if g_to < now - timeCycle * 1000 else \
+                min(g_to, int(df['time'].max()) if len(df) else g_from)
+            for itemId, name in tdef.items():
+                store.write(self._sn, itemId, timeCycle,
+                            df['time'].values, df[name].values, g_from, covered_to)
+        return store.frame(self._sn, itemIds, timeCycle, t_from, t_to)
+
     def batch_hist_alarms(self, p_severities=[600, 800], p_offset=0, p_limit=None, p_from=None, p_to=None):
         """
         Get pandas dataFrame of Events history, either limit or From & to are required
@@ -319,23 +725,7 @@ class Engine(object):
         p_to                string timestamp in milliseconds.
         """
         try:
-            tt = r""
-            if p_limit:
-                tt = r"&offset=" + str(p_offset) + \
-                    r"&limit=" + str(p_limit)
-            else:
-                if p_from and p_to:
-                    tt = r'&from=' + str(arrow.get(p_from).timestamp * 1000) + \
-                        r'&to=' + str(arrow.get(p_to).timestamp * 1000)
-                else:
-                    raise Exception(
-                        r"batch_hist_alarms, invalid Parameters")
-
-            tsvj = ','.join([str(s) for s in p_severities])
-
-            url = r'/asset/' + str(self.id) + \
-                r'/history/alarms' + \
-                r'?severities=' + str(tsvj) + tt
+            url = self._alarms_url(p_severities, p_offset, p_limit, p_from, p_to)
 
             # fetch messages from myplant ....
             messages = self._mp.fetchdata(url)
@@ -346,6 +736,133 @@ class Engine(object):
         except:
             raise
 
+    def _alarms_url(self, p_severities, p_offset, p_limit, p_from, p_to):
+        """
+        internal
+        /history/alarms url, see batch_hist_alarms
+        """
+        tt = r""
+        if p_limit:
+            tt = r"&offset=" + str(p_offset) + \
+                r"&limit=" + str(p_limit)
+        else:
+            if p_from and p_to:
+                tt = r'&from=' + str(arrow.get(p_from).timestamp * 1000) + \
+                    r'&to=' + str(arrow.get(p_to).timestamp * 1000)
+            else:
+                raise Exception(
+                    r"batch_hist_alarms, invalid Parameters")
+
+        tsvj = ','.join([str(s) for s in p_severities])
+
+        return r'/asset/' + str(self.id) + \
+            r'/history/alarms' + \
+            r'?severities=' + str(tsvj) + tt
+
+    def iter_hist_alarms(self, p_severities=[600, 800], p_from=None, p_to=None, page_size=1000, window=30 * 86400,
+                         records=False):
+        """
+        Generator over the Events history, fetches one page at a time
+        without p_from & p_to the messages are paged by offset/limit
+        until a page comes back short, else p_from .. p_to is walked
+        in time windows.
+        p_severities        list   see batch_hist_alarms
+        p_from              string from iso date or timestamp,
+        p_to                string stop iso date or timestamp.
+        page_size           int64, messages per page in offset mode
+        window              int64, seconds per page in time mode
+        records             bool   yield dicts per message instead of
+                                   a pandas DataFrame per page
+
+        e.g.: for dm in e.iter_hist_alarms(p_from='2019-01-01', p_to='2021-01-01'): ...
+        """
+        def fetch(url):
+            messages = self._mp.fetchdata(url)
+            if messages is None:
+                raise MyPlantException(f'{self._sn}: {url} failed')
+            return pd.DataFrame(messages)
+
+        if p_from and p_to:
+            windows = self._split_windows(arrow.get(p_from).timestamp, arrow.get(p_to).timestamp,
+                                          1, window + 1)
+            for i, (w_from, w_to) in enumerate(windows):
+                dm = fetch(self._alarms_url(
+                    p_severities, 0, None, w_from, w_to))
+                if i < len(windows) - 1 and 'timestamp' in dm:
+                    # messages on the boundary come again with the next window
+                    dm = dm[dm['timestamp'] < w_to * 1000]
+                if len(dm):
+                    yield from (dm.to_dict('records') if records else [dm])
+        else:
+            offset = 0
+            while True:
+                dm = fetch(self._alarms_url(
+                    p_severities, offset, page_size, None, None))
+                if len(dm):
+                    yield from (dm.to_dict('records') if records else [dm])
+                if len(dm) < page_size:
+                    return
+                offset += page_size
+
+    def alarms_to_parquet(self, fname, **kwargs):
+        """
+        Write the Events history page by page to the parquet file fname,
+        memory use is bounded by one page. Requires pyarrow.
+        The pages are spooled to temporary files first, the file schema
+        is the union of all pages: columns of later pages are added,
+        all-null columns take the type of later pages, conflicting
+        types are promoted (int -> double, else string).
+        kwargs .. see iter_hist_alarms
+        returns the number of messages written
+        """
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError('alarms_to_parquet requires pyarrow, pip install pyarrow')
+
+        def promote(a, b):
+            if a == b:
+                return a
+            try:
+                return pa.unify_schemas([pa.schema([('x', a)]), pa.schema([('x', b)])],
+                                        promote_options='permissive').field('x').type
+            except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+                return pa.large_string()
+
+        def column(table, field):
+            if field.name not in table.column_names:
+                return pa.nulls(len(table), field.type)
+            return table.column(field.name).cast(field.type)
+
+        kwargs['records'] = False
+        count = 0
+        types = {}
+        parts = []
+        tmpdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(fname)))
+        try:
+            for dm in self.iter_hist_alarms(**kwargs):
+                table = pa.Table.from_pandas(dm, preserve_index=False)
+                for field in table.schema:
+                    types[field.name] = promote(types[field.name], field.type) \
+                        if field.name in types else field.type
+                parts.append(os.path.join(tmpdir, f'{len(parts):06d}.parquet'))
+                pq.write_table(table, parts[-1])
+                count += len(dm)
+            if not parts:
+                return count
+            schema = pa.schema(list(types.items()))
+            tmp = os.path.join(tmpdir, 'result.parquet')
+            with pq.ParquetWriter(tmp, schema) as writer:
+                for part in parts:
+                    table = pq.read_table(part)
+                    writer.write_table(pa.Table.from_arrays(
+                        [column(table, field) for field in schema], schema=schema))
+            os.replace(tmp, fname)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        return count
+
     @ property
     def id(self):
         """
@@ -603,15 +1120,22 @@ class EngineReadOnly(Engine):
     def __init__(self, sn):
         """
         ReadOnly Engine Constructor
-        load Instance from Engine Pickle File
+        load Instance from the Engine snapshot,
+        the asset is loaded on first access
         """
         self._sn = str(sn)
-        self._picklefile = os.getcwd() + '/data/' + self._sn + '.pkl'
-        try:
-            with open(self._picklefile, 'rb') as handle:
-                self.__dict__ = pickle.load(handle)
-        except FileNotFoundError:
-            logging.debug(f"{self._picklefile} not found.")
+        self._set_filenames()
+        snap = self._load_snapshot()
+        if snap is None:
+            legacy = self._load_legacy()
+            if legacy is None:
+                logging.debug(f"{self._cachefile} not found.")
+                return
+            self._eng = legacy['_eng']
+        else:
+            self._eng = snap['eng']
+        self._d = self._engine_data(self._eng)
+        self._set_oph_parameter()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,265 @@
+﻿import os
+import json
+import logging
+import tempfile
+import threading
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from dmyplant2.support import FileLock
+
+
+def merge_intervals(intervals):
+    """merge overlapping or touching [from, to] intervals"""
+    merged = []
+    for f, t in sorted(intervals):
+        if merged and f <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], t)
+        else:
+            merged.append([f, t])
+    return merged
+
+
+def missing_intervals(p_from, p_to, covered):
+    """parts of [p_from, p_to] not in the merged intervals covered"""
+    gaps = []
+    start = p_from
+    for f, t in covered:
+        if t < start:
+            continue
+        if f > p_to:
+            break
+        if f > start:
+            gaps.append((start, f))
+        start = max(start, t)
+    if start < p_to:
+        gaps.append((start, p_to))
+    return gaps
+
+
+class HistoryStore(object):
+    """
+    Local columnar time series store for Engine dataItem history
+
+    One series per engine, dataItem and timeCycle, stored as raw
+    int64 timestamps [ms] and float64 values in
+        <path>/<sn>/<itemId>_<timeCycle>.ts
+        <path>/<sn>/<itemId>_<timeCycle>.val
+    The per engine index.json holds the number of valid rows and
+    remembers the time ranges already downloaded, so a sync fetches
+    only the missing tail and gaps. Writes hold the per engine
+    index.lock and reread index.json, several instances and
+    processes can share a store.
+
+    The files are memory-mapped, reads of a time slice are NumPy
+    views into the page cache, nothing is copied or parsed.
+
+    e.g.:
+        store = HistoryStore()
+        df = e.sync_hist_dataItems({161: 'CountOph'}, p_from='2020-01-01', store=store)
+        ts, val = store.read(e._sn, 161, 86400, p_from, p_to)     # views
+    """
+
+    def __init__(self, path=None):
+        """HistoryStore Constructor
+            path .. store directory, default ./data/history"""
+        self._path = path if path else os.getcwd() + '/data/history'
+        os.makedirs(self._path, exist_ok=True)
+        self._lock = threading.RLock()
+        self._indexes = {}
+        self._flocks = {}
+        self._maps = {}
+
+    @staticmethod
+    def _name(itemId, timeCycle):
+        return f'{int(itemId)}_{int(timeCycle)}'
+
+    def _dir(self, sn):
+        return os.path.join(self._path, str(sn))
+
+    def _files(self, sn, itemId, timeCycle):
+        base = os.path.join(self._dir(sn), self._name(itemId, timeCycle))
+        return base + '.ts', base + '.val'
+
+    def _flock(self, sn):
+        """internal, lock of engine sn shared with other instances and processes"""
+        sn = str(sn)
+        with self._lock:
+            if sn not in self._flocks:
+                self._flocks[sn] = FileLock(os.path.join(self._dir(sn), 'index.lock'))
+            return self._flocks[sn]
+
+    def _index(self, sn, reload=False):
+        """
+        internal, index of engine sn
+        reread whenever index.json was replaced, reload forces it
+        """
+        sn = str(sn)
+        fname = os.path.join(self._dir(sn), 'index.json')
+        try:
+            st = os.stat(fname)
+            sig = (st.st_ino, st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            sig = None
+        cached = self._indexes.get(sn, None)
+        if cached is not None and cached[0] == sig and not reload:
+            return cached[1]
+        try:
+            with open(fname, 'r', encoding='utf-8') as handle:
+                index = json.load(handle)
+        except FileNotFoundError:
+            index = {}
+        except ValueError:
+            logging.error(f'history index of {sn} is corrupt, ignored.')
+            index = {}
+        self._indexes[sn] = (sig, index)
+        return index
+
+    def _save_index(self, sn, index):
+        """internal, write the index of engine sn atomically"""
+        d = self._dir(sn)
+        fd, tmp = tempfile.mkstemp(dir=d, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as handle:
+                json.dump(index, handle)
+            os.replace(tmp, os.path.join(d, 'index.json'))
+        except:
+            os.remove(tmp)
+            raise
+
+    def covered(self, sn, itemId, timeCycle):
+        """downloaded [from, to] intervals in ms"""
+        with self._lock, self._flock(sn):
+            entry = self._index(sn).get(self._name(itemId, timeCycle), None)
+            return [list(x) for x in entry['covered']] if entry else []
+
+    def missing(self, sn, itemId, timeCycle, p_from, p_to):
+        """[(from, to), ..] in ms of p_from .. p_to not downloaded yet"""
+        return missing_intervals(p_from, p_to, self.covered(sn, itemId, timeCycle))
+
+    def _map(self, sn, itemId, timeCycle):
+        """
+        internal
+        read only memory maps (timestamps, values) of the valid rows,
+        a map is reused until the series is written again
+        """
+        name = self._name(itemId, timeCycle)
+        entry = self._index(sn).get(name, None)
+        n = entry['n'] if entry else 0
+        version = (n, entry.get('version', 0) if entry else 0)
+        key = (str(sn), name)
+        cached = self._maps.get(key, None)
+        if cached is not None and cached[0] == version:
+            return cached[1], cached[2]
+        if n == 0:
+            ts, val = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        else:
+            fts, fval = self._files(sn, itemId, timeCycle)
+            ts = np.memmap(fts, dtype=np.int64, mode='r', shape=(n,))
+            val = np.memmap(fval, dtype=np.float64, mode='r', shape=(n,))
+        self._maps[key] = (version, ts, val)
+        return ts, val
+
+    def read(self, sn, itemId, timeCycle, p_from=None, p_to=None):
+        """
+        stored series as (timestamps [ms], values), optionally
+        limited to p_from .. p_to [ms]. Zero copy, both are read only
+        views on the memory mapped files.
+        """
+        with self._lock, self._flock(sn):
+            ts, val = self._map(sn, itemId, timeCycle)
+        lo = 0 if p_from is None else np.searchsorted(ts, p_from, side='left')
+        hi = len(ts) if p_to is None else np.searchsorted(ts, p_to, side='right')
+        return ts[lo:hi], val[lo:hi]
+
+    def series(self, sn, itemId, timeCycle, p_from=None, p_to=None, name=None):
+        """stored series as pandas Series indexed by time [ms], without copy"""
+        ts, val = self.read(sn, itemId, timeCycle, p_from, p_to)
+        return pd.Series(val, index=pd.Index(ts, name='time', copy=False), name=name, copy=False)
+
+    def scan(self, itemId, timeCycle, p_from=None, p_to=None):
+        """
+        generator over all engines in the store with the series,
+        yields (sn, timestamps, values) views
+        """
+        for sn in sorted(os.listdir(self._path)):
+            if os.path.isdir(self._dir(sn)) and self._name(itemId, timeCycle) in self._index(sn):
+                ts, val = self.read(sn, itemId, timeCycle, p_from, p_to)
+                yield sn, ts, val
+
+    def _replace(self, fname, arr):
+        """
+        internal
+        rewrite fname via temp file and rename,
+        open memory maps keep seeing the old file
+        """
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fname), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as handle:
+                handle.write(arr.tobytes())
+            os.replace(tmp, fname)
+        except:
+            os.remove(tmp)
+            raise
+
+    def write(self, sn, itemId, timeCycle, times, values, p_from, p_to):
+        """
+        add downloaded data of p_from .. p_to [ms] to the series,
+        new points after the stored ones are appended,
+        anything else is merged (new values win on equal timestamps)
+        """
+        times = np.asarray(times, dtype=np.int64)
+        values = np.asarray(pd.to_numeric(values, errors='coerce'), dtype=np.float64)
+        order = np.argsort(times, kind='stable')
+        times, values = times[order], values[order]
+        name = self._name(itemId, timeCycle)
+        fts, fval = self._files(sn, itemId, timeCycle)
+        os.makedirs(self._dir(sn), exist_ok=True)
+        with self._lock, self._flock(sn):
+            # another instance may have written since, never trust a cached index
+            index = self._index(sn, reload=True)
+            entry = index.setdefault(name, {'n': 0, 'covered': []})
+            old_ts, old_val = self._map(sn, itemId, timeCycle)
+            if len(old_ts) == 0 or len(times) == 0 or times[0] > old_ts[-1]:
+                # rows beyond 'n' are left overs of an interrupted write
+                for fname, arr, size in ((fts, times, 8), (fval, values, 8)):
+                    with open(fname, 'ab') as handle:
+                        handle.truncate(entry['n'] * size)
+                        handle.write(arr.tobytes())
+                entry['n'] = len(old_ts) + len(times)
+            else:
+                ts = np.concatenate([times, old_ts])
+                val = np.concatenate([values, old_val])
+                # np.unique keeps the first occurrence, i.e. the new value
+                ts, first = np.unique(ts, return_index=True)
+                val = val[first]
+                self._replace(fts, ts)
+                self._replace(fval, val)
+                entry['n'] = len(ts)
+            entry['covered'] = merge_intervals(
+                entry['covered'] + [[int(p_from), int(p_to)]])
+            entry['updated'] = datetime.now().timestamp()
+            entry['version'] = entry.get('version', 0) + 1
+            self._save_index(sn, index)
+
+    def frame(self, sn, itemIds, timeCycle, p_from=None, p_to=None):
+        """
+        stored dataItems as pandas DataFrame, columns 'time' + names
+        itemIds .. dict dataItem id: name
+        """
+        if len(itemIds) == 1:
+            # single series, no alignment needed: columns are views
+            (itemId, name), = itemIds.items()
+            ts, val = self.read(sn, itemId, timeCycle, p_from, p_to)
+            return pd.DataFrame({'time': ts, name: val}, copy=False)
+        cols = {}
+        for itemId, name in itemIds.items():
+            cols[name] = self.series(sn, itemId, timeCycle, p_from, p_to)
+        df = pd.DataFrame(cols).sort_index()
+        df.index.name = 'time'
+        return df.reset_index()[['time'] + list(itemIds.values())]
+
+    @property
+    def path(self):
+        """the store directory"""
+        return self._path
@@ -0,0 +1,119 @@
+﻿import re
+import logging
+import threading
+from collections import deque
+from datetime import datetime
+from urllib.parse import urlsplit
+import numpy as np
+import pandas as pd
+
+_id = re.compile(r'/\d+(?=/|$)')
+
+
+def template(url) -> str:
+    """
+    endpoint template of url, ids replaced and query removed
+    e.g. '/asset/123/history/data?from=..' -> '/asset/{id}/history/data'
+    """
+    return _id.sub('/{id}', urlsplit(url).path)
+
+
+class RequestMetrics(object):
+    """
+    Per request metrics of a MyPlant object
+
+    Every call is recorded as a dict in a ring buffer of 'size' entries:
+        time      .. epoch timestamp of the call
+        kind      .. 'login', 'fetchdata', 'fetchstream' or 'io'
+        endpoint  .. endpoint template, see template()
+        status    .. http status code, None if the server was unreachable
+        latency   .. seconds until the response arrived, including
+                     scheduler wait and retries
+        wait      .. seconds waited for the rate limiter
+        decode    .. seconds spent decoding json
+        bytes     .. response size
+        retries   .. number of retries
+        cached    .. True if served from the response cache
+
+    hook is called with every entry, e.g. to export to a metrics system.
+
+    e.g.:
+        mp = MyPlant(on_request=lambda m: statsd.timing(m['endpoint'], m['latency']))
+        mp.stats()
+    """
+
+    def __init__(self, size=10000, hook=None):
+        """RequestMetrics Constructor
+            size .. ring buffer size
+            hook .. callable(entry) or None"""
+        self._buffer = deque(maxlen=size)
+        self._lock = threading.Lock()
+        self.hook = hook
+
+    def record(self, kind, endpoint, status=None, latency=0.0, wait=0.0, decode=0.0,
+               bytes=0, retries=0, cached=False):
+        """add one entry"""
+        entry = {
+            'time': datetime.now().timestamp(),
+            'kind': kind,
+            'endpoint': endpoint,
+            'status': status,
+            'latency': latency,
+            'wait': wait,
+            'decode': decode,
+            'bytes': bytes,
+            'retries': retries,
+            'cached': cached
+        }
+        with self._lock:
+            self._buffer.append(entry)
+        if self.hook is not None:
+            try:
+                self.hook(entry)
+            except Exception as err:
+                logging.error(f'metrics hook failed: {err}')
+        return entry
+
+    @property
+    def records(self):
+        """copy of the ring buffer as list of dicts"""
+        with self._lock:
+            return list(self._buffer)
+
+    def frame(self):
+        """ring buffer as pandas DataFrame"""
+        return pd.DataFrame(self.records, columns=[
+            'time', 'kind', 'endpoint', 'status', 'latency', 'wait',
+            'decode', 'bytes', 'retries', 'cached'])
+
+    def stats(self):
+        """
+        summary per kind and endpoint as pandas DataFrame:
+        count, errors, cache hits, p50/p95 latency and decode time,
+        total bytes and retries
+        """
+        df = self.frame()
+        rows = []
+        for (kind, ep), g in df.groupby(['kind', 'endpoint'], sort=True):
+            status = pd.to_numeric(g['status'])
+            rows.append({
+                'kind': kind,
+                'endpoint': ep,
+                'count': len(g),
+                # no status: server unreachable, except for local io
+                'errors': int((status >= 400).sum() + (status.isna().sum() if kind != 'io' else 0)),
+                'cached': int(g['cached'].sum()),
+                'latency p50': np.percentile(g['latency'], 50),
+                'latency p95': np.percentile(g['latency'], 95),
+                'decode p50': np.percentile(g['decode'], 50),
+                'decode p95': np.percentile(g['decode'], 95),
+                'wait total': g['wait'].sum(),
+                'bytes': int(g['bytes'].sum()),
+                'retries': int(g['retries'].sum())
+            })
+        return pd.DataFrame(rows)
+
+    def clear(self):
+        """empty the ring buffer"""
+        with self._lock:
+            self._buffer.clear()
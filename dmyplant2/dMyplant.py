@@ -1,12 +1,23 @@
 ﻿import json
 import base64
 import requests
+import requests.adapters
 import logging
 import os
 from datetime import datetime, timedelta
 import time
+import random
+from email.utils import parsedate_to_datetime
 import pickle
+import copy
+import threading
+import asyncio
+import functools
+import contextvars
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
 import pandas as pd
+from dmyplant2.dMetrics import RequestMetrics, template
 
 
 def epoch_ts(ts) -> float:
@@ -34,8 +45,67 @@ errortext = {
     401: 'The supplied authentication is invalid',
     403: 'No permission to access this resource',
     404: 'No data was found',
-    500: 'Internal Server Error'
+    429: 'Too Many Requests',
+    500: 'Internal Server Error',
+    502: 'Bad Gateway',
+    503: 'Service Unavailable',
+    504: 'Gateway Timeout'
 }
+# responses worth another try after a backoff
+retry_codes = {429, 500, 502, 503, 504}
+
+
+class AssetIndex(object):
+    """
+    Name indexed view of a raw MyPlant asset json
+
+    The 'properties' and 'dataItems' lists are indexed by item name
+    on first access, every further lookup is a dict access.
+    MyPlant.gdi keeps the index of the last few payloads.
+
+    e.g.:
+        ai = AssetIndex(mp.asset_data(sn))
+        oph = ai.value('dataItems', 'Count_OpHour')
+    """
+
+    def __init__(self, ds):
+        self._ds = ds
+        self._index = {}
+
+    def _items(self, sub_key):
+        """internal, name: item dict for sub_key, rebuilt if the list changed"""
+        items = self._ds.get(sub_key, None)
+        if items is None:
+            return {}
+        if isinstance(items, dict):     # already restructured by name
+            return items
+        cached = self._index.get(sub_key, None)
+        if cached is None or cached[0] is not items or cached[1] != len(items):
+            cached = (items, len(items), {x['name']: x for x in items})
+            self._index[sub_key] = cached
+        return cached[2]
+
+    def item(self, sub_key, name):
+        """the complete item dict of name or None"""
+        if sub_key == 'nokey':
+            return self._ds.get(name, None)
+        return self._items(sub_key).get(name, None)
+
+    def value(self, sub_key, name):
+        """value of name, sub_key 'nokey', 'properties' or 'dataItems'"""
+        if sub_key == 'nokey':
+            return self._ds.get(name, None)
+        item = self._items(sub_key).get(name, None)
+        return item.get('value', None) if item is not None else None
+
+    def items(self, sub_key):
+        """dict name: item of sub_key"""
+        return self._items(sub_key)
+
+    @property
+    def ds(self):
+        """the indexed asset json"""
+        return self._ds
 
 
 class MyPlant(object):
@@ -45,75 +115,363 @@ class MyPlant(object):
     _session = None
     _caching = 0
 
-    def __init__(self, caching=7200):
-        """MyPlant Constructor"""
+    def __init__(self, caching=7200, pool_size=20, retries=4, backoff=0.5, max_backoff=30.0, timeout=120.0,
+                 cache=None, scheduler=None, base_url=None, credentials=None, metrics_size=10000, on_request=None):
+        """MyPlant Constructor
+            caching     .. Engine cache time in seconds
+            pool_size   .. number of keep-alive connections kept open
+            retries     .. retries on 429/5xx responses and dropped connections
+            backoff     .. base of the exponential backoff in seconds
+            max_backoff .. upper limit for a single backoff wait
+            timeout     .. http request timeout in seconds
+            cache       .. optional dCache.ResponseCache for fetchdata
+            scheduler   .. optional dScheduler.RequestScheduler, rate limits requests
+            base_url    .. server url, default burl, e.g. a dServer.MyPlantStandIn
+            credentials .. dict with base64 'name' and 'password',
+                           default ./data/.credentials
+            metrics_size.. number of requests kept in the metrics ring buffer
+            on_request  .. callable(entry), called after every request, see dMetrics"""
         self._caching = caching
+        self._cache = cache
+        self._scheduler = scheduler
+        self._base_url = base_url
+        self._metrics = RequestMetrics(size=metrics_size, hook=on_request)
+        self._pool_size = pool_size
+        self._retries = retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._timeout = timeout
+        # guards the session against concurrent logins from worker threads
+        self._lock = threading.RLock()
+        # url -> Future of the request currently on the wire
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        # id(ds) -> AssetIndex of the last asset_indexes payloads used in gdi
+        self._asset_indexes = OrderedDict()
+        self._asset_indexes_lock = threading.Lock()
         # load and manage credentials from hidden file
         try:
-            with open("./data/.credentials", "r", encoding='utf-8-sig') as file:
-                cred = json.load(file)
+            if credentials is None:
+                with open("./data/.credentials", "r", encoding='utf-8-sig') as file:
+                    cred = json.load(file)
+            else:
+                cred = credentials
             self._name = cred['name']
             self._password = cred['password']
         except FileNotFoundError:
             raise
 
+    def __getstate__(self):
+        """
+        the Engine pickle files of versions before the snapshot format
+        hold a MyPlant object, keep them loadable for the migration in
+        Engine._load_legacy. Leave out the session, locks and the thread
+        bound cache/scheduler/metrics helpers.
+        """
+        state = self.__dict__.copy()
+        for k in ('_lock', '_inflight', '_inflight_lock', '_session', '_cache', '_scheduler', '_metrics',
+                  '_asset_indexes', '_asset_indexes_lock'):
+            state.pop(k, None)
+        return state
+
+    def __setstate__(self, state):
+        """
+        an unpickled MyPlant has no response cache and no scheduler
+        and starts with empty metrics, pass them to a new MyPlant
+        """
+        self.__dict__.update(state)
+        logging.debug('unpickled MyPlant: response cache, scheduler and metrics are not restored')
+        self._lock = threading.RLock()
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        self._cache = None
+        self._scheduler = None
+        self._metrics = RequestMetrics()
+        self._asset_indexes = OrderedDict()
+        self._asset_indexes_lock = threading.Lock()
+
     def deBase64(self, text):
         return base64.b64decode(text).decode('utf-8')
 
+    def _new_session(self):
+        """
+        internal
+        requests session with a connection pool large enough
+        for parallel engine fetches, retries are handled in _request
+        """
+        session = requests.session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=self._pool_size, pool_maxsize=self._pool_size, max_retries=0)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def _backoff_time(self, attempt, response=None):
+        """
+        internal
+        seconds to wait before retry #attempt,
+        honors the Retry-After header, else exponential backoff with jitter
+        """
+        if response is not None:
+            retry_after = response.headers.get('Retry-After', None)
+            if retry_after:
+                try:
+                    return min(float(retry_after), self._max_backoff)
+                except ValueError:
+                    try:
+                        delta = parsedate_to_datetime(
+                            retry_after).timestamp() - time.time()
+                        return min(max(delta, 0.0), self._max_backoff)
+                    except (TypeError, ValueError):
+                        pass
+        delay = min(self._backoff * (2 ** attempt), self._max_backoff)
+        return delay / 2.0 + random.uniform(0.0, delay / 2.0)
+
     def login(self):
-        """Login to MyPlant"""
+        """Login to MyPlant, returns the logged in session"""
+        with self._lock:
+            return self._login()
+
+    def _login(self):
+        """
+        internal, Login to MyPlant, caller holds self._lock
+        returns the logged in session
+        """
         if self._session is None:
             logging.debug(f"SSO {self.deBase64(self._name)} MyPlant login")
-            self._session = requests.session()
+            session = self._new_session()
             headers = {'Content-Type': 'application/json', }
             body = {
                 "username": self.deBase64(self._name),
                 "password": self.deBase64(self._password)
             }
-            loop = 1
-            try:
-                while loop < 3:
-                    response = self._session.post(burl + "/auth",
-                                                  data=json.dumps(body), headers=headers)
+            start = time.perf_counter()
+            for attempt in range(self._retries + 1):
+                response = None
+                try:
+                    response = session.post(self.base_url + "/auth",
+                                            data=json.dumps(body), headers=headers, timeout=self._timeout)
                     if response.status_code == 200:
                         logging.debug(f'login {self._name} successful.')
-                        break
-                    else:
-                        logging.error(
-                            f'login failed with response code {response.status_code}')
-                    loop += 1
-                    logging.error(f'Myplant login attempt #{loop}')
-                    time.sleep(1)
-                if loop >= 3:
-                    logging.error(f'Login {self._name} failed')
-                    raise MyPlantException(
-                        f'Login {self._name} failed')
-            except:
-                raise
+                        self._session = session
+                        self._metrics.record('login', '/auth', status=200, latency=time.perf_counter() - start,
+                                             bytes=len(response.content), retries=attempt)
+                        return session
+                    logging.error(
+                        f'login failed with response code {response.status_code}')
+                    if response.status_code in (400, 401, 403):
+                        break   # wrong credentials, retrying won't help
+                except (requests.ConnectionError, requests.Timeout) as err:
+                    logging.error(f'login failed: {err}')
+                if attempt < self._retries:
+                    logging.error(f'Myplant login attempt #{attempt + 2}')
+                    time.sleep(self._backoff_time(attempt, response))
+            session.close()
+            self._metrics.record('login', '/auth', status=response.status_code if response is not None else None,
+                                 latency=time.perf_counter() - start, retries=attempt)
+            logging.error(f'Login {self._name} failed')
+            raise MyPlantException(
+                f'Login {self._name} failed')
+        return self._session
+
+    def _relogin(self, session):
+        """
+        internal
+        the session expired, login again -
+        only once if several threads hit the 401 together
+        """
+        with self._lock:
+            if self._session is session:
+                logging.debug('session expired, MyPlant re-login')
+                self._session.close()
+                self._session = None
+            self._login()
 
     def logout(self):
         """Logout from Myplant and release self._session"""
-        if self._session != None:
-            self._session.close()
-            self._session = None
+        with self._lock:
+            if self._session != None:
+                self._session.close()
+                self._session = None
 
-    def fetchdata(self, url):
-        """login and return data based on url"""
+    def _request(self, url, priority=None, stream=False, info=None):
+        """
+        internal
+        GET base_url + url, retries with backoff on 429/5xx and
+        dropped connections, re-login once on 401.
+        returns the last response, raises if the server is unreachable
+        info .. dict, receives 'retries' and scheduler 'wait' time
+        """
+        info = info if info is not None else {}
+        info['retries'] = 0
+        info['wait'] = 0.0
+        relogin = True
+        attempt = 0
+        while True:
+            info['retries'] = attempt
+            # taken under the lock, another thread may log out meanwhile
+            session = self.login()
+            if self._scheduler is not None:
+                info['wait'] += self._scheduler.acquire(url, priority)
+            try:
+                response = session.get(
+                    self.base_url + url, timeout=self._timeout, stream=stream)
+            except (requests.ConnectionError, requests.Timeout) as err:
+                if attempt >= self._retries:
+                    raise
+                logging.warning(f'{url}: {err}, retry #{attempt + 1}')
+                time.sleep(self._backoff_time(attempt))
+                attempt += 1
+                continue
+            if self._scheduler is not None:
+                self._scheduler.feedback(url, response.status_code)
+            if response.status_code == 401 and relogin:
+                relogin = False
+                response.close()
+                self._relogin(session)
+                continue
+            if response.status_code in retry_codes and attempt < self._retries:
+                logging.warning(
+                    f'{url}: {response.status_code}, retry #{attempt + 1}')
+                response.close()
+                time.sleep(self._backoff_time(attempt, response))
+                attempt += 1
+                continue
+            return response
+
+    def fetchdata(self, url, priority=None, cache=True):
+        """
+        login and return data based on url
+        identical concurrent requests are sent only once,
+        all callers get (a copy of) the same result
+        priority .. dScheduler priority class, used with a scheduler
+        cache    .. False skips the lookup in the response cache,
+                    the fresh response is still stored there
+        """
+        key = url if cache else (url, 'fresh')
+        with self._inflight_lock:
+            future = self._inflight.get(key, None)
+            leader = future is None
+            if leader:
+                future = Future()
+                future.followers = 0
+                self._inflight[key] = future
+            else:
+                future.followers += 1
+        if not leader:
+            logging.debug(f'fetchdata: wait for request in flight {url}')
+            # callers may modify the result (see Engine._restructure),
+            # everybody gets a private copy, the shared result stays untouched
+            return copy.deepcopy(future.result())
+        try:
+            res = self._fetchdata(url, priority, cache)
+        except BaseException as err:
+            self._inflight_done(key)
+            future.set_exception(err)
+            raise
+        # no follower can join once the request is out of _inflight
+        followers = self._inflight_done(key)
+        future.set_result(res)
+        return copy.deepcopy(res) if followers else res
+
+    def _inflight_done(self, key):
+        """internal, end coalescing for key, returns the number of followers"""
+        with self._inflight_lock:
+            return self._inflight.pop(key).followers
+
+    def _fetchdata(self, url, priority=None, cache=True):
+        """internal, login and return data based on url"""
+        ep = template(url)
+        start = time.perf_counter()
+        info = {}
         try:
-            self.login()
             logging.debug(f'url: {url}')
-            response = self._session.get(burl + url)
+            if self._cache is not None and cache:
+                res = self._cache.get(url)
+                if res is not None:
+                    logging.debug(f'fetchdata: {url} from cache')
+                    self._metrics.record('fetchdata', ep, status=200,
+                                         latency=time.perf_counter() - start, cached=True)
+                    return res
+            response = self._request(url, priority, info=info)
+            latency = time.perf_counter() - start
             if response.status_code == 200:
                 logging.debug(f'fetchdata: download successful')
+                start = time.perf_counter()
                 res = response.json()
+                self._metrics.record('fetchdata', ep, status=200, latency=latency,
+                                     wait=info['wait'], decode=time.perf_counter() - start,
+                                     bytes=len(response.content), retries=info['retries'])
+                if self._cache is not None:
+                    self._cache.put(url, res)
                 return res
             else:
+                self._metrics.record('fetchdata', ep, status=response.status_code, latency=latency,
+                                     wait=info['wait'], bytes=len(response.content), retries=info['retries'])
                 logging.error(
-                    f' Code: {url}, {response.status_code}, {errortext[response.status_code]}')
-        except:
+                    f' Code: {url}, {response.status_code}, {errortext.get(response.status_code, response.reason)}')
+        except (requests.ConnectionError, requests.Timeout):
+            self._metrics.record('fetchdata', ep, latency=time.perf_counter() - start,
+                                 wait=info.get('wait', 0.0), retries=info.get('retries', 0))
             raise
 
-    def asset_data(self, serialNumber):
+    def fetchstream(self, url, decoder, chunk_size=65536, priority=None):
+        """
+        login and feed the response of url chunk by chunk into decoder,
+        e.g. a dStream.BatchDataDecoder, without loading it as a whole.
+        returns decoder or None if the request failed
+        """
+        logging.debug(f'url: {url}')
+        ep = template(url)
+        start = time.perf_counter()
+        nbytes = 0
+        decode = 0.0
+
+        def feed(chunk):
+            nonlocal nbytes, decode
+            t0 = time.perf_counter()
+            decoder.feed(chunk)
+            decode += time.perf_counter() - t0
+            nbytes += len(chunk)
+
+        if self._cache is not None:
+            handle = self._cache.open(url)
+            if handle is not None:
+                logging.debug(f'fetchstream: {url} from cache')
+                with handle:
+                    for chunk in iter(lambda: handle.read(chunk_size), b''):
+                        feed(chunk)
+                decoder.close()
+                self._metrics.record('fetchstream', ep, status=200, latency=time.perf_counter() - start,
+                                     decode=decode, bytes=nbytes, cached=True)
+                return decoder
+        info = {}
+        response = self._request(url, priority, stream=True, info=info)
+        with response:
+            if response.status_code != 200:
+                self._metrics.record('fetchstream', ep, status=response.status_code,
+                                     latency=time.perf_counter() - start, wait=info['wait'],
+                                     retries=info['retries'])
+                logging.error(
+                    f' Code: {url}, {response.status_code}, {errortext.get(response.status_code, response.reason)}')
+                return None
+            if self._cache is not None:
+                with self._cache.spool(url) as spool:
+                    for chunk in response.iter_content(chunk_size):
+                        spool.write(chunk)
+                        feed(chunk)
+                    decoder.close()
+            else:
+                for chunk in response.iter_content(chunk_size):
+                    feed(chunk)
+                decoder.close()
+        # latency covers the whole transfer, decode the time spent in the decoder
+        self._metrics.record('fetchstream', ep, status=200, latency=time.perf_counter() - start,
+                             wait=info['wait'], decode=decode, bytes=nbytes, retries=info['retries'])
+        logging.debug(f'fetchstream: download successful')
+        return decoder
+
+    def asset_data(self, serialNumber, cache=True):
         """
         Returns an Asset based on its id with all details
         including properties and DataItems.
@@ -121,10 +479,11 @@ class MyPlant(object):
         Parameters:
         Name	    type    Description
         sn          int     IB ItemNumber Engine
+        cache       bool    False fetches from MyPlant, not from the response cache
         ----------------------------------------------
         url: /asset?assetType=J-Engine&serialNumber=sn
         """
-        return self.fetchdata(url=r"/asset?assetType=J-Engine&serialNumber=" + str(serialNumber))
+        return self.fetchdata(url=r"/asset?assetType=J-Engine&serialNumber=" + str(serialNumber), cache=cache)
 
     def historical_dataItem(self, id, itemId, timestamp):
         """
@@ -152,13 +511,32 @@ class MyPlant(object):
         return self.fetchdata(url=fr"/asset/{id}/history/data?from={p_from}&to={p_to}&assetType=J-Engine&dataItemId={itemId}&timeCycle={timeCycle}&includeMinMax=false&forceDownSampling=false")
 
     def gdi(self, ds, sub_key, data_item_name):
-        """Unpack value from Myplant Json datastructure based on key & DataItemName"""
-        if sub_key == 'nokey':
-            return ds.get(data_item_name, None)
-        else:
-            local = {x['value']
-                     for x in ds[sub_key] if x['name'] == data_item_name}
-            return local.pop() if len(local) != 0 else None
+        """
+        Unpack value from Myplant Json datastructure based on key & DataItemName
+        ds may be the raw asset json or an AssetIndex,
+        the name index is built once per payload
+        """
+        return self._asset_index(ds).value(sub_key, data_item_name)
+
+    def _asset_index(self, ds, maxsize=4):
+        """
+        internal
+        AssetIndex of the asset json ds, the last maxsize payloads
+        keep theirs. An entry holds its payload, so its id is not reused
+        while it is cached; AssetIndex rebuilds a list that changed.
+        """
+        if isinstance(ds, AssetIndex):
+            return ds
+        with self._asset_indexes_lock:
+            ai = self._asset_indexes.get(id(ds), None)
+            if ai is not None and ai.ds is ds:
+                self._asset_indexes.move_to_end(id(ds))
+                return ai
+            ai = AssetIndex(ds)
+            self._asset_indexes[id(ds)] = ai
+            while len(self._asset_indexes) > maxsize:
+                self._asset_indexes.popitem(last=False)
+            return ai
 
     # def d(self, ts):
     #     return pd.Timestamp(ts, unit='s')
@@ -176,3 +554,110 @@ class MyPlant(object):
     def caching(self):
         """the current cache time"""
         return self._caching
+
+    @property
+    def metrics(self):
+        """dMetrics.RequestMetrics of this session"""
+        return self._metrics
+
+    def stats(self):
+        """per endpoint request summary (count, p50/p95 latency, bytes ..) as pandas DataFrame"""
+        return self._metrics.stats()
+
+    @property
+    def base_url(self):
+        """the MyPlant server url"""
+        return self._base_url if self._base_url else burl
+
+    @property
+    def cache(self):
+        """the http response cache or None"""
+        return self._cache
+
+    @property
+    def scheduler(self):
+        """the request scheduler or None"""
+        return self._scheduler
+
+
+class AsyncMyPlant(object):
+    """
+    asyncio front end to MyPlant
+
+    The blocking MyPlant calls are run in a thread pool, at most
+    'concurrency' requests are on the wire at the same time.
+    The wrapped MyPlant object (and its session) is shared, sync
+    callers can keep on using it.
+
+    e.g.:
+        amp = AsyncMyPlant(MyPlant(), concurrency=8)
+        assets = asyncio.run(amp.gather(urls))
+    """
+
+    def __init__(self, mp=None, concurrency=8, caching=7200):
+        """AsyncMyPlant Constructor
+            mp          .. MyPlant Object, created if None
+            concurrency .. max number of parallel requests
+            caching     .. cache time, used if mp is created here"""
+        self._mp = mp if mp is not None else MyPlant(caching)
+        self._concurrency = max(int(concurrency), 1)
+        self._executor = ThreadPoolExecutor(
+            max_workers=self._concurrency, thread_name_prefix='myplant')
+
+    async def _run(self, func, *args, **kwargs):
+        """
+        internal, run a blocking MyPlant call in the thread pool,
+        in a copy of the task context (e.g. the scheduler priority)
+        """
+        loop = asyncio.get_running_loop()
+        ctx = contextvars.copy_context()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(ctx.run, func, *args, **kwargs))
+
+    async def login(self):
+        """Login to MyPlant"""
+        return await self._run(self._mp.login)
+
+    async def logout(self):
+        """Logout from Myplant"""
+        return await self._run(self._mp.logout)
+
+    async def fetchdata(self, url, priority=None, cache=True):
+        """login and return data based on url"""
+        return await self._run(self._mp.fetchdata, url, priority, cache)
+
+    async def asset_data(self, serialNumber, cache=True):
+        """Returns an Asset based on its serialNumber, see MyPlant.asset_data"""
+        return await self._run(self._mp.asset_data, serialNumber, cache)
+
+    async def historical_dataItem(self, id, itemId, timestamp):
+        """see MyPlant.historical_dataItem"""
+        return await self._run(self._mp.historical_dataItem, id, itemId, timestamp)
+
+    async def history_dataItem(self, id, itemId, p_from, p_to, timeCycle=3600):
+        """see MyPlant.history_dataItem"""
+        return await self._run(self._mp.history_dataItem, id, itemId, p_from, p_to, timeCycle)
+
+    async def gather(self, urls, return_exceptions=False):
+        """
+        fetch many urls concurrently
+        returns the results in the order of urls,
+        with return_exceptions=True failed requests return the exception
+        """
+        await self.login()
+        return await asyncio.gather(*[self.fetchdata(url) for url in urls],
+                                    return_exceptions=return_exceptions)
+
+    def close(self):
+        """shut down the thread pool, the MyPlant session stays open"""
+        self._executor.shutdown(wait=True)
+
+    @property
+    def mp(self):
+        """the wrapped MyPlant object"""
+        return self._mp
+
+    @property
+    def concurrency(self):
+        """max number of parallel requests"""
+        return self._concurrency
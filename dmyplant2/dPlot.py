@@ -17,7 +17,7 @@ import matplotlib.ticker as ticker
 import matplotlib.dates as dates
 
 # Load Application imports
-from dmyplant2.dReliability import demonstrated_reliability_sr
+from dmyplant2.dReliability import demonstrated_reliability_grid
 
 
 def idx(n, s, e, x):
@@ -42,9 +42,12 @@ def demonstrated_Reliabillity_Plot(vl, beta=1.21, T=30000, s=1000, ft=pd.DataFra
 
     fcol = 'grey'
 
-    # calculate the x axis timerange first
-    tr = demonstrated_reliability_sr(vl,
-                                     start_ts, last_ts, beta=beta, size=s, ft=ft)[0]  # timestamp x axis start .. end
+    # calculate the x axis timerange start .. end and the demonstrated
+    # reliability curves for the complete period, confidence intervals CL,
+    # in one pass
+    tr, dr, _ = demonstrated_reliability_grid(vl, start_ts, last_ts,
+                                             CL=[c/100.0 for c in cl], beta=beta, size=s, ft=ft, T=T)
+    rel = {c: dr.loc[(beta, T, c/100.0)].values for c in cl}
 
     # determine the array - index of 'now'
     n_i = idx(s, start_ts, last_ts, vl.now_ts)
@@ -54,11 +57,6 @@ def demonstrated_Reliabillity_Plot(vl, beta=1.21, T=30000, s=1000, ft=pd.DataFra
 
     # convert to datetime dates - start .. last
     dtr = [datetime.fromtimestamp(t) for t in tr]
-    # calculate demonstrated reliability curves for the complete period,
-    # confidence intervals CL :
-    rel = {c: demonstrated_reliability_sr(vl, start_ts, last_ts,
-                                          CL=c/100.0, beta=beta, size=s, ft=ft, T=T)[1] for c in cl}
-
     # convert to datetime dates - start .. now
     n_dtr = [datetime.fromtimestamp(t) for t in n_tr]
     # copy demontrated reliability values for the validation period up to now:
@@ -113,10 +111,10 @@ def demonstrated_Reliabillity_Plot(vl, beta=1.21, T=30000, s=1000, ft=pd.DataFra
     for e in vl.engines[:]:
         #print(e.Name, e._d['Engine ID'], e._d['val start'], e._d['oph parts'])
         # complete interval in color fcal
-        y = [e.oph(t) for t in tr]
+        y = e.oph(tr)
         ax2.plot(dtr, y, linewidth=0.5, color=fcol)
         # the current validation interval in multiple colors
-        n_y = [e.oph(t) for t in n_tr]
+        n_y = e.oph(n_tr)
         ax2.plot(n_dtr, n_y, label=f"{e.Name} {e._d['Engine ID']}")
 
     # NOW plot some Orientation Lines and Test into the Plot
@@ -143,7 +141,7 @@ def demonstrated_Reliabillity_Plot(vl, beta=1.21, T=30000, s=1000, ft=pd.DataFra
     ax1.axis((datetime.fromtimestamp(start_ts),
               datetime.fromtimestamp(last_ts), 0, 120))
     # oph Fleet Leader
-    fl = [e.oph2(vl.now_ts) for e in vl.engines]
+    fl = list(vl.oph_matrix(vl.now_ts, method='oph2')[:, 0])
     fl_point_x = datetime.fromtimestamp(vl.now_ts)
     ax2.scatter(fl_point_x, max(fl), marker='o', color='black', label='point')
     fl_txt_x = datetime.fromtimestamp(vl.now_ts + 200000)
@@ -5,6 +5,9 @@ Created on Sun Oct 25 11:03:06 2020
 
 @author: dieterchvatal
 """
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
 from scipy.stats.distributions import chi2
@@ -12,42 +15,273 @@ from scipy.stats.distributions import chi2
 #from dmyplant.dValidation import Validation
 
 
+# chi-square quantiles by (CL, degrees of freedom), shared by all calls,
+# see chi2_table / chi2_preload to hand it to worker processes
+_chi2_table = {}
+_chi2_lock = threading.Lock()
+
+
+def chi2_quantile(CL, dof) -> float:
+    """chi2.ppf(CL, dof), every (CL, dof) pair is evaluated once"""
+    key = (float(CL), float(dof))
+    q = _chi2_table.get(key, None)
+    if q is None:
+        q = chi2.ppf(key[0], key[1])
+        with _chi2_lock:
+            _chi2_table[key] = q
+    return q
+
+
+def chi2_quantiles(CL, dof):
+    """
+    chi2.ppf(CL, dof) for an array of degrees of freedom,
+    looked up for the distinct values only
+    CL .. value or array, the result has one row per CL then
+    """
+    dof = np.asarray(dof, dtype=np.float64)
+    uniq, inverse = np.unique(dof, return_inverse=True)
+    inverse = inverse.reshape(dof.shape)
+    if np.ndim(CL) == 0:
+        return np.array([chi2_quantile(CL, d) for d in uniq], dtype=np.float64)[inverse]
+    return np.array([[chi2_quantile(c, d) for d in uniq] for c in CL], dtype=np.float64)[:, inverse]
+
+
+def chi2_table():
+    """copy of the chi-square quantile table"""
+    with _chi2_lock:
+        return dict(_chi2_table)
+
+
+def chi2_preload(table):
+    """add quantiles of chi2_table(), e.g. in a worker process initializer"""
+    with _chi2_lock:
+        _chi2_table.update(table)
+
+
 def lipson_equality(p, t1, t2, beta) -> float:
     nl = p * ((t1/t2) ** beta)
     pl = nl/p
     return (nl, pl)
 
 
+class FailureIndex(object):
+    """
+    Failures sorted by time with cumulative counts,
+    the number of failures before any set of timestamps
+    is a single searchsorted.
+
+    Build it once from the failures DataFrame (date, failures)
+    and pass it as ft to the reliability functions.
+    e.g.:
+        fi = FailureIndex(ft)
+        for beta in [0.8, 1.0, 1.21]:
+            demonstrated_reliability_sr(vl, start, end, beta=beta, ft=fi)
+    """
+
+    def __init__(self, ft=None):
+        """FailureIndex Constructor
+            ft .. pandas DataFrame, 1st column date, 2nd column number of failures"""
+        if isinstance(ft, pd.DataFrame) and not ft.empty:
+            times = np.array([row[0].timestamp() for row in ft.values], dtype=np.float64)
+            counts = np.array([row[1] for row in ft.values], dtype=np.float64)
+        else:
+            times = counts = np.empty(0, dtype=np.float64)
+        order = np.argsort(times, kind='stable')
+        self._times = times[order]
+        # _cum[i] .. failures up to, excluding, self._times[i]
+        self._cum = np.concatenate([[0.0], np.cumsum(counts[order])])
+
+    def count(self, ts):
+        """
+        number of failures strictly before ts,
+        ts -> epoch timestamp or array of epoch timestamps
+        """
+        return self._cum[np.searchsorted(self._times, ts, side='left')]
+
+    def __len__(self):
+        return len(self._times)
+
+    @property
+    def times(self):
+        """sorted failure timestamps"""
+        return self._times
+
+    @property
+    def total(self):
+        """number of all failures"""
+        return float(self._cum[-1])
+
+
+def _failures(t_arr, ft):
+    """
+    internal
+    number of failures vs time array, based on a FailureIndex or
+    the failures DataFrame information (date, failures)
+    """
+    if not isinstance(ft, FailureIndex):
+        ft = FailureIndex(ft)
+    return ft.count(t_arr)
+
+
+def _lipson_parts(m, oph, tt_max, beta):
+    """
+    internal
+    sum all part's per lipson equality to max hours at time t,
+    summed engine by engine, like the builtin sum
+    """
+    parts = m[:, np.newaxis] * (oph / tt_max) ** beta
+    n_lip = 0
+    for row in parts:
+        n_lip = n_lip + row
+    return n_lip
+
+
+def _lipson_T(n_lip, tt_max, beta, T):
+    """
+    internal
+    use Lipson equality again to calc n@T hours,
+    scalar power per time point like before, the SIMD array power
+    of numpy may differ in the last bit
+    """
+    return n_lip * np.fromiter((x ** beta for x in tt_max / T), dtype=np.float64, count=len(tt_max))
+
+
 def demonstrated_reliability_sr(val, start, end, beta=1.21, CL=0.9, T=30000, ft=pd.DataFrame, size=10):
-    # failures array
-    f_arr = np.zeros(size)
     # time points array
     t_arr = np.linspace(start, end, size)
+    # failures array
+    f_arr = _failures(t_arr, ft)
+
+    # exeecute the algorithm on all time points at once
+    m = np.array([e.Cylinders for e in val.engines])
+    # oph of all engines at all time points, engines x time
+    oph = val.oph_matrix(t_arr)
+    tt_max = oph.max(axis=0)
+    # avoid division by zero, demonstrated Reliability is 0.0 there
+    valid = tt_max > 0.0
+    dr_arr = np.zeros(size)
+    if valid.any():
+        tt_max = tt_max[valid]
+        n_lip = _lipson_parts(m, oph[:, valid], tt_max, beta)
+        n_lip_T = _lipson_T(n_lip, tt_max, beta, T)
+        # calc demonstrated Reliability per Chi.square dist (see A.Kleyner Paper)
+        dr_arr[valid] = np.exp(-chi2_quantiles(CL, 2 * (f_arr[valid] + 1)) / (2 * n_lip_T)) * 100.0
+    return (t_arr, dr_arr, f_arr)
 
-    # populate the number of failures vs time array
-    # based on failures Dataframe information
-    if not(ft.empty):
-        for row in ft.values:
-            fl = np.where(t_arr > row[0].timestamp(), row[1], 0)
-            f_arr += fl
 
-    # initialize demonstrated Reliability vs. time array
-    dr_arr = []
+def demonstrated_reliability_grid(val, start, end, beta=1.21, CL=[0.1, 0.5, 0.9], T=30000, ft=pd.DataFrame, size=10):
+    """
+    demonstrated reliability for several confidence levels, and
+    optionally several beta and T values, in one pass.
+    Failures and engine oph are evaluated once, the Lipson sums once
+    per beta, the chi2 quantiles once for all CL.
+    beta, CL, T .. value or list of values
+    ft .. failures DataFrame (date, failures) or FailureIndex
+
+    returns (t_arr, dr, f_arr), dr is a pandas DataFrame with the
+    rows indexed by (beta, T, CL) and one column per time point,
+    each row equals demonstrated_reliability_sr(...)[1]
+    e.g.:
+        t, dr, f = demonstrated_reliability_grid(vl, start, end, CL=[0.1, 0.9], size=1000)
+        dr.loc[(1.21, 30000, 0.9)]
+    """
+    betas, cls, Ts = (list(np.atleast_1d(x)) for x in (beta, CL, T))
+    t_arr = np.linspace(start, end, size)
+    f_arr = _failures(t_arr, ft)
 
-    # exeecute the algorithm
     m = np.array([e.Cylinders for e in val.engines])
-    for i, t in enumerate(t_arr):
-        tt = np.array([e.oph(t) for e in val.engines])
-        tt_max = max(tt)
-        if tt_max > 0.0:  # avoid division by zero
-            # sum all part's per lipson equality to max hours at time t
-            n_lip = sum(m*(tt/tt_max) ** beta)
-            # use Lipson equality again to calc n@T hours
-            n_lip_T = n_lip * ((tt_max/T) ** beta)
-            # calc demonstrated Reliability per Chi.square dist (see A.Kleyner Paper)
-            dr = np.exp(-chi2.ppf(CL, 2*(f_arr[i]+1))/(2*n_lip_T)) * 100.0
-            # store in list for numpy vector
-            dr_arr.append(dr)
+    oph = val.oph_matrix(t_arr)
+    tt_max = oph.max(axis=0)
+    valid = tt_max > 0.0
+    dr = np.zeros((len(betas), len(Ts), len(cls), size))
+    if valid.any():
+        tt_max = tt_max[valid]
+        oph = oph[:, valid]
+        # chi2 quantiles, CL x time
+        q = chi2_quantiles(cls, 2 * (f_arr[valid] + 1))
+        for i, b in enumerate(betas):
+            n_lip = _lipson_parts(m, oph, tt_max, b)
+            for j, t in enumerate(Ts):
+                n_lip_T = _lipson_T(n_lip, tt_max, b, t)
+                dr[i, j][:, valid] = np.exp(-q / (2 * n_lip_T)) * 100.0
+    index = pd.MultiIndex.from_product([betas, Ts, cls], names=['beta', 'T', 'CL'])
+    return (t_arr, pd.DataFrame(dr.reshape(-1, size), index=index, columns=t_arr), f_arr)
+
+
+# state of a Monte Carlo worker process, see _mc_init
+_mc_state = None
+
+
+def _mc_init(state):
+    """internal, ProcessPoolExecutor initializer, the fleet data is sent once per worker"""
+    global _mc_state
+    _mc_state = state
+
+
+def _mc_block(seed, n, state=None):
+    """
+    internal
+    n demonstrated reliability curves with sampled beta and oph
+    slope factors, evaluated as one (samples x engines x time) block
+    returns np.array samples x valid time points
+    """
+    oph, m, q, T, beta, beta_sd, oph_sd = state if state is not None else _mc_state
+    rng = np.random.default_rng(seed)
+    B = np.maximum(rng.normal(beta, beta_sd, n), 1e-3)
+    # one slope factor per sample and engine, oph is linear in the slope
+    F = np.maximum(rng.normal(1.0, oph_sd, (n, len(m))), 1e-3)
+    ophs = F[:, :, np.newaxis] * oph[np.newaxis, :, :]
+    tt_max = ophs.max(axis=1)
+    n_lip = (m[np.newaxis, :, np.newaxis] *
+             (ophs / tt_max[:, np.newaxis, :]) ** B[:, np.newaxis, np.newaxis]).sum(axis=1)
+    n_lip_T = n_lip * (tt_max / T) ** B[:, np.newaxis]
+    return np.exp(-q / (2 * n_lip_T)) * 100.0
+
+
+def demonstrated_reliability_mc(val, start, end, beta=1.21, beta_sd=0.1, oph_sd=0.05, CL=0.9, T=30000,
+                                ft=pd.DataFrame, size=100, samples=1000, percentiles=[5, 50, 95],
+                                seed=None, block=None, max_workers=None):
+    """
+    Monte Carlo uncertainty bands of the demonstrated reliability.
+    Every sample draws beta ~ N(beta, beta_sd) and per engine a factor
+    ~ N(1, oph_sd) on the slope of the oph line (see Engine.oph), the
+    curves are evaluated in blocks of samples in a process pool.
+    beta_sd     .. standard deviation of beta
+    oph_sd      .. relative standard deviation of the oph slope
+    samples     .. number of sampled curves
+    percentiles .. list of percentiles of the bands
+    seed        .. int, the result does not depend on max_workers
+    block       .. samples per block, default keeps a block near 16 MB
+    max_workers .. worker processes, default os.cpu_count(), 1 runs in process
+    ft          .. failures DataFrame (date, failures) or FailureIndex
+
+    returns (t_arr, bands, f_arr), bands is a pandas DataFrame with
+    one row per percentile and one column per time point
+    e.g.:
+        t, bands, f = demonstrated_reliability_mc(vl, start, end, samples=5000, seed=1)
+        bands.loc[5], bands.loc[95]
+    """
+    t_arr = np.linspace(start, end, size)
+    f_arr = _failures(t_arr, ft)
+    m = np.array([e.Cylinders for e in val.engines], dtype=np.float64)
+    oph = val.oph_matrix(t_arr)
+    # the slope factors are > 0, the valid time points do not change
+    valid = oph.max(axis=0) > 0.0
+    dr = np.zeros((samples, size))
+    if valid.any():
+        state = (oph[:, valid], m, chi2_quantiles(CL, 2 * (f_arr[valid] + 1)),
+                 T, beta, beta_sd, oph_sd)
+        if block is None:
+            block = max(1, 2 * 1024 * 1024 // (len(m) * int(valid.sum())))
+        sizes = [min(block, samples - i) for i in range(0, samples, block)]
+        # one independent stream per block, reproducible for a given seed
+        seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+        max_workers = max_workers if max_workers else os.cpu_count() or 1
+        if max_workers == 1 or len(sizes) == 1:
+            blocks = [_mc_block(s, n, state) for s, n in zip(seeds, sizes)]
         else:
-            dr_arr.append(0.0)
-    return (t_arr, np.array(dr_arr), f_arr)
+            with ProcessPoolExecutor(max_workers=max_workers, initializer=_mc_init, initargs=(state,)) as ex:
+                blocks = list(ex.map(_mc_block, seeds, sizes))
+        dr[:, valid] = np.concatenate(blocks)
+    bands = np.percentile(dr, percentiles, axis=0)
+    return (t_arr, pd.DataFrame(bands, index=pd.Index(percentiles, name='percentile'), columns=t_arr), f_arr)
@@ -0,0 +1,183 @@
+﻿import time
+import heapq
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from dmyplant2.dCache import endpoint
+
+# priority classes, lower values are served first
+INTERACTIVE = 0
+NORMAL = 1
+BULK = 2
+
+# priority of the requests of the current context, see RequestScheduler.priority,
+# work handed to a thread pool keeps it when submitted with
+# contextvars.copy_context().run
+_priority = contextvars.ContextVar('dmyplant2_priority', default=NORMAL)
+
+# requests per second, burst size per endpoint
+default_budgets = {
+    'asset': (5.0, 10),
+    'dataitem': (5.0, 10),
+    'history': (4.0, 8),
+    'batchdata': (2.0, 4),
+    'alarms': (2.0, 4),
+    'other': (5.0, 10)
+}
+
+
+class TokenBucket(object):
+    """
+    Token bucket, refills 'rate' tokens per second up to 'burst' tokens
+    rate is adapted to the server: halved on throttling responses,
+    increased again slowly on success (AIMD)
+    """
+
+    def __init__(self, rate, burst):
+        self._max_rate = float(rate)
+        self._rate = float(rate)
+        self._burst = float(burst)
+        self._tokens = float(burst)
+        self._stamp = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self._burst, self._tokens +
+                           (now - self._stamp) * self._rate)
+        self._stamp = now
+
+    def wait_time(self) -> float:
+        """seconds until a token is available, 0.0 if one is available now"""
+        self._refill()
+        return 0.0 if self._tokens >= 1.0 else (1.0 - self._tokens) / self._rate
+
+    def take(self):
+        """consume one token"""
+        self._refill()
+        self._tokens -= 1.0
+
+    def throttled(self):
+        """server signaled overload, halve the rate"""
+        self._rate = max(self._rate / 2.0, self._max_rate / 64.0)
+        self._tokens = min(self._tokens, 0.0)
+
+    def succeeded(self):
+        """successful request, approach the configured rate again"""
+        self._rate = min(self._rate + self._max_rate / 20.0, self._max_rate)
+
+    @property
+    def rate(self):
+        """current rate in requests per second"""
+        return self._rate
+
+
+class RequestScheduler(object):
+    """
+    Client side rate limiter for the MyPlant API
+
+    Every endpoint ('asset', 'dataitem', 'history', 'batchdata', 'alarms')
+    has its own token bucket. Waiting requests are served by priority
+    class, INTERACTIVE before NORMAL before BULK, first come first served
+    within a class.
+
+    e.g.:
+        sched = RequestScheduler()
+        mp = MyPlant(scheduler=sched)
+        with sched.priority(BULK):
+            ... backfill ...
+        sched.stats
+    """
+
+    def __init__(self, budgets=None):
+        """RequestScheduler Constructor
+            budgets .. dict endpoint: (requests per second, burst), updates default_budgets"""
+        budgets = dict(default_budgets, **(budgets or {}))
+        self._buckets = {k: TokenBucket(*v) for k, v in budgets.items()}
+        self._queues = {k: [] for k in budgets}
+        self._cond = threading.Condition()
+        self._seq = 0
+        self._stats = {k: {'requests': 0, 'wait': 0.0, 'max_wait': 0.0, 'throttled': 0}
+                       for k in budgets}
+
+    @contextmanager
+    def priority(self, priority):
+        """
+        default priority for requests of the current context,
+        including the thread pools of MyPlant, Engine and Validation
+        """
+        token = _priority.set(priority)
+        try:
+            yield self
+        finally:
+            _priority.reset(token)
+
+    def _name(self, url):
+        name = endpoint(url)
+        return name if name in self._buckets else 'other'
+
+    def acquire(self, url, priority=None):
+        """
+        block until url may be sent
+        returns the time waited in seconds
+        """
+        if priority is None:
+            priority = _priority.get()
+        name = self._name(url)
+        queue = self._queues[name]
+        bucket = self._buckets[name]
+        start = time.monotonic()
+        with self._cond:
+            self._seq += 1
+            entry = (priority, self._seq)
+            heapq.heappush(queue, entry)
+            while True:
+                if queue[0] == entry:
+                    wait = bucket.wait_time()
+                    if wait <= 0.0:
+                        bucket.take()
+                        heapq.heappop(queue)
+                        self._cond.notify_all()
+                        break
+                    self._cond.wait(wait)
+                else:
+                    self._cond.wait()
+            waited = time.monotonic() - start
+            st = self._stats[name]
+            st['requests'] += 1
+            st['wait'] += waited
+            st['max_wait'] = max(st['max_wait'], waited)
+        if waited > 1.0:
+            logging.debug(f'scheduler: {name} request waited {waited:.1f}s')
+        return waited
+
+    def feedback(self, url, status_code):
+        """adapt the endpoint rate to the server response"""
+        name = self._name(url)
+        with self._cond:
+            if status_code in (429, 503):
+                self._buckets[name].throttled()
+                self._stats[name]['throttled'] += 1
+                logging.warning(
+                    f'scheduler: {name} throttled, rate {self._buckets[name].rate:.2f}/s')
+            elif status_code < 400:
+                self._buckets[name].succeeded()
+
+    @property
+    def queue_depth(self):
+        """number of waiting requests per endpoint"""
+        with self._cond:
+            return {k: len(v) for k, v in self._queues.items()}
+
+    @property
+    def stats(self):
+        """requests, waiting requests, mean/max wait time and current rate per endpoint"""
+        with self._cond:
+            return {k: {
+                'requests': v['requests'],
+                'queued': len(self._queues[k]),
+                'mean_wait': v['wait'] / v['requests'] if v['requests'] else 0.0,
+                'max_wait': v['max_wait'],
+                'throttled': v['throttled'],
+                'rate': self._buckets[k].rate
+            } for k, v in self._stats.items()}
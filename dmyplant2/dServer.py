@@ -0,0 +1,272 @@
+﻿import os
+import json
+import math
+import time
+import random
+import base64
+import logging
+import threading
+from datetime import datetime
+from urllib.parse import urlsplit, parse_qsl
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from dmyplant2.dMyplant import MyPlant
+from dmyplant2.dCache import ResponseCache, endpoint
+
+
+class MyPlantStandIn(object):
+    """
+    Local MyPlant stand-in server for offline tests and benchmarks
+
+    Serves /auth, /asset, /asset/{id}/dataitem/{id}, /history/data,
+    /history/batchdata and /history/alarms. Responses are taken from
+    recorded fixtures if available, else synthesized. Latency and
+    error injection are configurable.
+
+    Fixtures are the json files of a dCache.ResponseCache directory,
+    to record them run a real session with
+        MyPlant(cache=ResponseCache(path='fixtures', ttl={...}))
+
+    e.g.:
+        with MyPlantStandIn(latency=0.05, error_rate=0.01) as srv:
+            mp = srv.myplant()
+            vl = Validation(mp, dval)
+    """
+
+    def __init__(self, fixtures=None, latency=0.0, jitter=0.0, error_rate=0.0,
+                 error_codes=(500, 503), seed=None, host='127.0.0.1', port=0):
+        """MyPlantStandIn Constructor
+            fixtures    .. directory with recorded responses or None
+            latency     .. seconds added to every response
+            jitter      .. random extra latency 0 .. jitter seconds
+            error_rate  .. fraction of requests answered with an error
+            error_codes .. error status codes to choose from
+            seed        .. random seed for jitter and errors
+            host, port  .. address to listen on, port 0 picks a free port"""
+        self._fixtures = fixtures
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_codes = tuple(error_codes)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._counts = {}
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        """serve in a background thread"""
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._server.serve_forever, daemon=True)
+            self._thread.start()
+            logging.debug(f'MyPlant stand-in listening on {self.url}')
+        return self
+
+    def stop(self):
+        """shut down the server"""
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+
+    @property
+    def url(self):
+        """base url, use as MyPlant(base_url=...)"""
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def counts(self):
+        """number of requests served per endpoint"""
+        with self._lock:
+            return dict(self._counts)
+
+    def myplant(self, **kwargs):
+        """MyPlant object pointed at this server with dummy credentials"""
+        def enc(x): return base64.b64encode(x.encode('utf-8')).decode('utf-8')
+        kwargs.setdefault('credentials', {
+            'name': enc('standin'), 'password': enc('standin')})
+        return MyPlant(base_url=self.url, **kwargs)
+
+    def _handler(self):
+        """internal, request handler class bound to this server"""
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                logging.debug('stand-in: ' + format % args)
+
+            def _send(self, code, body=b'', headers=None):
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                self.rfile.read(length)
+                standin._count('auth')
+                if urlsplit(self.path).path != '/auth':
+                    return self._send(404)
+                standin._delay()
+                self._send(200, b'{}')
+
+            def do_GET(self):
+                standin._count(endpoint(self.path))
+                standin._delay()
+                code = standin._error()
+                if code:
+                    return self._send(code, b'{}', {'Retry-After': '0'} if code == 429 else None)
+                try:
+                    body = standin.response(self.path)
+                except KeyError:
+                    return self._send(404, b'{}')
+                self._send(200, body)
+
+        return Handler
+
+    def _count(self, name):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + 1
+
+    def _delay(self):
+        with self._lock:
+            delay = self.latency + self._random.uniform(0.0, self.jitter)
+        if delay > 0.0:
+            time.sleep(delay)
+
+    def _error(self):
+        with self._lock:
+            if self.error_rate and self._random.random() < self.error_rate:
+                return self._random.choice(self.error_codes)
+        return None
+
+    def response(self, url):
+        """
+        raw json response for url, recorded fixture or synthetic data
+        raises KeyError for unknown urls
+        """
+        if self._fixtures:
+            fname = os.path.join(self._fixtures, ResponseCache.key(url) + '.json')
+            if os.path.exists(fname):
+                with open(fname, 'rb') as handle:
+                    return handle.read()
+        return json.dumps(synthetic(url)).encode('utf-8')
+
+
+def _asset_id(sn):
+    return 100000 + int(sn) % 900000
+
+
+def _series(assetId, itemId, p_from, p_to, timeCycle):
+    """
+    internal
+    deterministic synthetic time series, timestamps in ms,
+    the value at t does not depend on the requested window
+    """
+    base = random.Random(assetId * 1000 + itemId).uniform(10.0, 1000.0)
+    step = int(timeCycle) * 1000
+    start = (int(p_from) // step + 1) * step if int(p_from) % step else int(p_from)
+    return [(t, round(base + 0.01 * (t / 3600000.0 % 1000) + math.sin(t / 1.0e7 + itemId), 3))
+            for t in range(start, int(p_to) + 1, step)]
+
+
+def synthetic(url):
+    """
+    synthetic MyPlant response for url
+    raises KeyError for unknown urls
+    """
+    parts = urlsplit(url)
+    path = [p for p in parts.path.split('/') if p]
+    q = dict(parse_qsl(parts.query))
+    now = int(datetime.now().timestamp() * 1000)
+    name = endpoint(url)
+    if name == 'asset' and len(path) == 1:
+        sn = q['serialNumber']
+        return synthetic_asset(sn)
+    if name == 'dataitem':
+        rnd = random.Random(int(path[1]) * 1000 + int(path[3]))
+        return {'value': round(rnd.uniform(0.0, 1000.0), 3),
+                'timestamp': int(q.get('timestamp', now))}
+    if name == 'history':
+        return [list(x) for x in _series(int(path[1]), int(q['dataItemId']),
+                                         q['from'], q['to'], q.get('timeCycle', 3600))]
+    if name == 'batchdata':
+        ids = [int(x) for x in q['dataItemIds'].split(',')]
+        cycle = int(q.get('timeCycle', 3600))
+        if 'limit' in q:
+            p_to = now - now % (cycle * 1000)
+            p_from = p_to - (int(q['limit']) - 1) * cycle * 1000
+        else:
+            p_from, p_to = int(q['from']), int(q['to'])
+        series = [_series(int(path[1]), i, p_from, p_to, cycle) for i in ids]
+        data = [[row[0][0], [[v[1]] for v in row]] for row in zip(*series)]
+        return {'columns': [['time'], ids], 'data': data}
+    if name == 'alarms':
+        assetId = int(path[1])
+        severities = [int(x) for x in q.get('severities', '800').split(',')]
+        # one message every 6 hours over the last two years
+        first = now - now % 21600000 - 2 * 365 * 86400000
+        times = range(first, now, 21600000)
+        if 'from' in q and 'to' in q:
+            times = [t for t in times if int(q['from']) <= t <= int(q['to'])]
+            offset, limit = 0, len(times)
+        else:
+            offset, limit = int(q.get('offset', 0)), int(q.get('limit', 100))
+        times = sorted(times, reverse=True)[offset:offset + limit]
+        return [{'timestamp': t,
+                 'severity': severities[(t // 21600000) % len(severities)],
+                 'name': str(1000 + (assetId + t // 21600000) % 97),
+                 'message': f'synthetic message {(assetId + t // 21600000) % 97}'}
+                for t in times]
+    raise KeyError(url)
+
+
+def synthetic_asset(sn):
+    """synthetic /asset response for serialNumber sn"""
+    sn = int(sn)
+    rnd = random.Random(sn)
+    now = int(datetime.now().timestamp() * 1000)
+    props = {
+        'Engine Series': '6',
+        'Engine Type': '624',
+        'Engine Version': 'H12',
+        'Engine ID': f'M{sn % 1000:03d}',
+        'Design Number': str(1000 + sn % 100),
+        'IB ItemNumber Engine': str(sn),
+        'IB Unit Commissioning Date': '2020-01-01',
+        'IB Control Software': 'DIA.NE XT4',
+        'IB Item Description Engine': 'J624 H12',
+        'IB Project Name': f'Project {sn}'
+    }
+    items = {
+        'Count_OpHour': rnd.randint(5000, 30000),
+        'Count_Start': rnd.randint(100, 2000),
+        'Power_PowerNominal': 4500.0,
+        'Para_Speed_Nominal': 1500.0,
+        'halio_power_fact_cos_phi': 1.0,
+        'RMD_ListBuffMAvgOilConsume_OilConsumption': round(rnd.uniform(0.05, 0.3), 3)
+    }
+    return {
+        'id': _asset_id(sn),
+        'serialNumber': str(sn),
+        'model': 'J-Engine',
+        'status': {'lastDataFlowDate': now - rnd.randint(0, 3600000)},
+        'properties': [{'id': 1000 + i, 'name': k, 'value': v}
+                       for i, (k, v) in enumerate(props.items())],
+        'dataItems': [{'id': 100 + i, 'name': k, 'value': v, 'unit': '',
+                       'timestamp': now} for i, (k, v) in enumerate(items.items())]
+    }
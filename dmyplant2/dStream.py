@@ -0,0 +1,199 @@
+﻿import json
+import codecs
+import numpy as np
+import pandas as pd
+
+_ws = ' \t\n\r'
+
+# upper limit of the preallocated rows, beyond that the arrays grow
+# with the data actually received
+max_initial_rows = 65536
+
+
+class BatchDataDecoder(object):
+    """
+    Incremental decoder for /history/batchdata responses
+
+        {"columns": [[...], [id1, id2, ...]],
+         "data": [[ts, [[v1], [v2], ...]], ...]}
+
+    Bytes are fed as they arrive, every row of 'data' is decoded on its
+    own and written straight into preallocated NumPy column arrays,
+    the response is never held in memory as a whole.
+
+    e.g.:
+        dec = BatchDataDecoder(expected=8760)
+        for chunk in response.iter_content(65536):
+            dec.feed(chunk)
+        dec.close()
+        df = dec.frame({161: 'CountOph'})
+    """
+
+    def __init__(self, expected=1024):
+        """BatchDataDecoder Constructor
+            expected .. expected number of rows, initial array size,
+                        at most max_initial_rows"""
+        self._text = codecs.getincrementaldecoder('utf-8')()
+        self._decoder = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        self._state = 'start'
+        self._key = None
+        self._capacity = min(max(int(expected), 16), max_initial_rows)
+        self._n = 0
+        self._times = np.empty(self._capacity, dtype=np.int64)
+        self._values = None
+        self._other = {}
+
+    def feed(self, chunk):
+        """decode the next chunk of bytes"""
+        self._buf = self._buf[self._pos:] + self._text.decode(chunk)
+        self._pos = 0
+        self._parse(final=False)
+
+    def close(self):
+        """all bytes fed, raises ValueError on an incomplete response"""
+        self._buf = self._buf[self._pos:] + self._text.decode(b'', final=True)
+        self._pos = 0
+        self._parse(final=True)
+        if self._state != 'done':
+            raise ValueError('incomplete batchdata response')
+
+    def _skip(self):
+        """internal, skip whitespace, returns next char or None"""
+        buf = self._buf
+        pos = self._pos
+        while pos < len(buf) and buf[pos] in _ws:
+            pos += 1
+        self._pos = pos
+        return buf[pos] if pos < len(buf) else None
+
+    def _value(self, final):
+        """internal, decode one complete json value or return (False, None)"""
+        try:
+            value, end = self._decoder.raw_decode(self._buf, self._pos)
+        except json.JSONDecodeError:
+            if final:
+                raise
+            return False, None
+        if end >= len(self._buf) and not final and not isinstance(value, (list, dict, str)):
+            return False, None  # a number may continue in the next chunk
+        self._pos = end
+        return True, value
+
+    def _parse(self, final):
+        """internal, state machine over the top level object"""
+        while True:
+            c = self._skip()
+            if c is None:
+                return
+            if self._state == 'start':
+                if c != '{':
+                    raise ValueError('batchdata response is not an object')
+                self._pos += 1
+                self._state = 'key'
+            elif self._state == 'key':
+                if c == '}':
+                    self._pos += 1
+                    self._state = 'done'
+                    continue
+                if c == ',':
+                    self._pos += 1
+                    continue
+                ok, key = self._value(final)
+                if not ok:
+                    return
+                self._key = key
+                self._state = 'colon'
+            elif self._state == 'colon':
+                if c != ':':
+                    raise ValueError(f'batchdata response: ":" expected')
+                self._pos += 1
+                self._state = 'rows' if self._key == 'data' else 'value'
+            elif self._state == 'value':
+                ok, value = self._value(final)
+                if not ok:
+                    return
+                self._other[self._key] = value
+                self._state = 'key'
+            elif self._state == 'rows':
+                if c == 'n':    # "data": null
+                    ok, value = self._value(final)
+                    if not ok:
+                        return
+                    self._state = 'key'
+                    continue
+                if c != '[':
+                    raise ValueError('batchdata response: data list expected')
+                self._pos += 1
+                self._state = 'row'
+            elif self._state == 'row':
+                if c == ']':
+                    self._pos += 1
+                    self._state = 'key'
+                    continue
+                if c == ',':
+                    self._pos += 1
+                    continue
+                ok, row = self._value(final)
+                if not ok:
+                    return
+                self._append(row)
+            elif self._state == 'done':
+                raise ValueError('batchdata response: data after end')
+
+    def _append(self, row):
+        """internal, store one data row"""
+        ts, items = row[0], row[1]
+        if self._values is None:
+            self._values = np.full(
+                (self._capacity, len(items)), np.nan, dtype=np.float64)
+        if self._n >= self._capacity:
+            self._capacity *= 2
+            self._times = np.resize(self._times, self._capacity)
+            values = np.full(
+                (self._capacity, self._values.shape[1]), np.nan, dtype=self._values.dtype)
+            values[:self._n] = self._values[:self._n]
+            self._values = values
+        self._times[self._n] = ts
+        for j, item in enumerate(items):
+            v = item[0] if item else None
+            if v is None:
+                continue
+            try:
+                self._values[self._n, j] = v
+            except (TypeError, ValueError):
+                # non numeric dataItem, fall back to python objects
+                self._values = self._values.astype(object)
+                self._values[self._n, j] = v
+        self._n += 1
+
+    @property
+    def columns(self):
+        """the 'columns' entry of the response"""
+        return self._other.get('columns', None)
+
+    @property
+    def times(self):
+        """timestamps in ms, view on the decoded rows"""
+        return self._times[:self._n]
+
+    @property
+    def values(self):
+        """2d array rows x dataItems, view on the decoded rows"""
+        if self._values is None:
+            ncol = len(self.columns[1]) if self.columns else 0
+            return np.empty((0, ncol), dtype=np.float64)
+        return self._values[:self._n]
+
+    def frame(self, itemIds):
+        """
+        pandas DataFrame with columns 'time' + dataItem names
+        itemIds .. dict dataItem id: name
+        """
+        labels = ['time'] + [itemIds[x] for x in self.columns[1]]
+        values = self.values
+        d = {'time': self.times}
+        for j, label in enumerate(labels[1:]):
+            d[label] = values[:, j]
+        return pd.DataFrame(d, columns=labels)
@@ -3,6 +3,9 @@ from functools import reduce
 import pandas as pd
 import numpy as np
 import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from dmyplant2.dMyplant import MyPlantException
 from dmyplant2.dEngine import Engine
 from pprint import pprint as pp
 from scipy.stats.distributions import chi2
@@ -31,29 +34,39 @@ class Validation:
     _val = None
     _engines = []
 
-    def __init__(self, mp, dval, eval_date=None, cui_log=False):
+    def __init__(self, mp, dval, eval_date=None, cui_log=False, stale=False, max_workers=8):
         """ Myplant Validation object
             collects and provides the engines list.
             compiles a dashboard as pandas DataFrame
             dval ... Pandas DataFrame with the Validation Definition,
                      defined in Excel sheet 'validation'
+            stale .. serve expired engine caches immediately and
+                     refresh them in the background, see wait_refresh
+            max_workers .. number of engines constructed in parallel,
+                     1 builds them one after the other
         """
         self._mp = mp
         self._val = dval
         self._now_ts = datetime.now().timestamp()
         self._eval_ts = self._now_ts if not eval_date else eval_date
         self._valstart_ts = dval['val start'].min()
+        self._key_indexes = {}
+        self._frames = {}
 
         engines = self._val.to_dict('records')
-        # create and initialise all Engine Instances
+        # create and initialise all Engine Instances,
+        # logged in validation order as they become ready
         self._engines = []
-        for eng in engines:
-            e = Engine(mp, eng)
-            self._engines.append(e)
-            log = f"{eng['n']:02d} {e}"
-            logging.info(log)
-            if cui_log:
-                print(log)
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as ex:
+            futures = [ex.submit(contextvars.copy_context().run, Engine, mp, eng, stale=stale)
+                       for eng in engines]
+            for eng, future in zip(engines, futures):
+                e = future.result()
+                self._engines.append(e)
+                log = f"{eng['n']:02d} {e}"
+                logging.info(log)
+                if cui_log:
+                    print(log)
 
         # iterate over engines and columns
         #ldash = [[e._d[c] for c in self._dashcols] for e in self._engines]
@@ -81,31 +94,90 @@ class Validation:
     # def valstart(self):
     #     return self._valstart_ts
 
+    @ property
+    def refreshing(self):
+        """number of engines with a background refresh running"""
+        return sum(e.refreshing for e in self._engines)
+
+    def wait_refresh(self, timeout=None):
+        """
+        wait for the background refreshes of all engines and
+        rebuild the dashboard, returns the engines that failed
+        """
+        failed = [e for e in self._engines if not e.wait_refresh(timeout)]
+        self._dash = pd.DataFrame([e.dash for e in self._engines])
+        return failed
+
     @ property
     def dashboard(self):
         """ Validation Dasboard as Pandas DataFrame """
         return self._dash
 
+    def _refresh_signature(self):
+        """internal, changes whenever an engine got new data from MyPlant"""
+        return tuple(e.__dict__.get('_last_fetch_date', 0.0) for e in self._engines)
+
+    def _key_index(self, key):
+        """
+        internal
+        fleet index of the asset 'properties' or 'dataItems'
+        name -> {'name', 'id', 'unit', 'engines'}
+        name, id and unit are taken from the first engine with a value
+        ('properties') or a name ('dataItems'), engines are the positions
+        of the engines carrying the item. Cached until an engine refreshes.
+        """
+        sig = self._refresh_signature()
+        cached = self._key_indexes.get(key, None)
+        if cached is not None and cached[0] == sig:
+            return cached[1]
+        test = 'value' if key == 'properties' else 'name'
+        index = {}
+        for i, e in enumerate(self._engines):
+            for k, d in getattr(e, key).items():
+                entry = index.get(k, None)
+                if entry is None:
+                    entry = index[k] = {'name': None, 'id': None, 'unit': None, 'engines': []}
+                if 'id' in d or 'name' in d:    # not just a placeholder of get_data
+                    entry['engines'].append(i)
+                if entry['name'] is None and d.get(test, None):
+                    entry.update(name=d.get('name', None), id=d.get('id', None), unit=d.get('unit', None))
+        index = {k: index[k] for k in sorted(index, key=str.lower)}
+        self._key_indexes[key] = (sig, index)
+        return index
+
+    def _columns(self, key):
+        """
+        internal
+        values of all asset 'properties' or 'dataItems' as dict
+        name -> list in engine order, None where an engine lacks the item
+        """
+        items = [getattr(e, key) for e in self._engines]
+        cols = {}
+        for k, entry in self._key_index(key).items():
+            col = [None] * len(items)
+            for i in entry['engines']:
+                col[i] = items[i][k].get('value', None)
+            cols[k] = col
+        return cols
+
+    def _frame(self, name, build):
+        """internal, DataFrame cached until an engine refreshes"""
+        sig = self._refresh_signature()
+        cached = self._frames.get(name, None)
+        if cached is None or cached[0] != sig:
+            cached = self._frames[name] = (sig, build())
+        return cached[1].copy()
+
     @ property
     def properties_keys(self):
         """
         Properties: Collect all Keys from all Validation engines
         in a list - remove double entries
         """
-        keys = []
-        for e in self._engines:
-            keys += e.properties.keys()     # add keys of each engine
-            keys = list(set(keys))          # remove all double entries
-        keys = sorted(keys, key=str.lower)
-        dd = []
-        for k in keys:                      # for all keys in all Val Engines
-            for e in self._engines:         # iterate through al engines
-                if k in e.properties.keys():
-                    d = e.properties.get(k, None)  # get property dict
-                    if d['value']:                 # if value exists
-                        dd.append([d['name'], d['id']])  # store name, id pair
-                        break
-        return pd.DataFrame(dd, columns=['name', 'id'])
+        index = self._key_index('properties')
+        return self._frame('properties_keys', lambda: pd.DataFrame(
+            [[v['name'], v['id']] for v in index.values() if v['name']],
+            columns=['name', 'id']))
 
     @ property
     def dataItems_keys(self):
@@ -113,24 +185,10 @@ class Validation:
         DataItems: Collect all Keys from all Validation engines
         in a list - remove double entries
         """
-        keys = []
-        for e in self._engines:
-            keys += e.dataItems.keys()     # add keys of each engine
-            keys = list(set(keys))          # remove all double entries
-        keys = sorted(keys, key=str.lower)
-        dd = []
-        for k in keys:                      # for all keys in all Val Engines
-            for e in self._engines:         # iterate through al engines
-                if k in e.dataItems.keys():
-                    d = e.dataItems.get(k, None)  # get dataItem dict
-                    if d.get('name', None):                 # if value exists
-                        dd.append([
-                            d.get('name', None),
-                            d.get('unit', None),
-                            d.get('id', None)
-                        ])
-                        break
-        return pd.DataFrame(dd, columns=['name', 'unit', 'id'])
+        index = self._key_index('dataItems')
+        return self._frame('dataItems_keys', lambda: pd.DataFrame(
+            [[v['name'], v['unit'], v['id']] for v in index.values() if v['name']],
+            columns=['name', 'unit', 'id']))
 
     @ property
     def properties(self):
@@ -138,21 +196,16 @@ class Validation:
         Properties: Asset Data properties of all Engines
         as Pandas DataFrame
         """
-        # Collect all Keys in a big list and remove double counts
-        keys = []
-        for e in self._engines:
-            keys += e.properties.keys()  # add keys of each engine
-            keys = list(set(keys))  # remove all double entries
-        keys = sorted(keys, key=str.lower)
-        try:
+        def build():
+            cols = self._columns('properties')
+            keys = list(cols)
             keys.remove('IB ItemNumber Engine')
             keys.insert(0, 'IB ItemNumber Engine')
-        except ValueError:
-            raise
-        # Collect all values in a Pandas DateFrame
-        loc = [[e.get_property(k)
-                for k in keys] + [e.id, e.Name] for e in self._engines]
-        return pd.DataFrame(loc, columns=keys + ['AssetID', 'Name'])
+            df = pd.DataFrame({k: cols[k] for k in keys}, columns=keys)
+            df['AssetID'] = [e.id for e in self._engines]
+            df['Name'] = [e.Name for e in self._engines]
+            return df
+        return self._frame('properties', build)
 
     @ property
     def dataItems(self):
@@ -160,15 +213,12 @@ class Validation:
         dataItems: Asset Data dataItems of all Engines
         as Pandas DataFrame
         """
-        # Collect all Keys in a big list and remove double counts
-        keys = []
-        for e in self._engines:
-            keys += e.dataItems.keys()
-            keys = list(set(keys))
-        keys = sorted(keys, key=str.lower)
-        loc = [[e.get_dataItem(k)
-                for k in keys] + [e.Name] for e in self._engines]
-        return pd.DataFrame(loc, columns=keys + ['Name'])
+        def build():
+            cols = self._columns('dataItems')
+            df = pd.DataFrame(cols, columns=list(cols))
+            df['Name'] = [e.Name for e in self._engines]
+            return df
+        return self._frame('dataItems', build)
 
     @ property
     def validation_definition(self):
@@ -184,6 +234,73 @@ class Validation:
         """
         return self._engines
 
+    def oph_parameters(self, method='oph'):
+        """
+        stacked oph line parameters of all engines
+        method 'oph' or 'oph2', see Engine._set_oph_parameter
+        returns (k, valstart_ts) as np.arrays in engine order
+        """
+        kname = {'oph': '_k', 'oph2': '_k2'}[method]
+        k = np.array([getattr(e, kname) for e in self._engines], dtype=np.float64)
+        vs = np.array([e._valstart_ts for e in self._engines], dtype=np.float64)
+        return k, vs
+
+    def oph_matrix(self, ts, method='oph'):
+        """
+        oph of all engines at timestamps ts in one broadcast
+        ts     .. epoch timestamp or array of epoch timestamps
+        method .. 'oph' or 'oph2'
+        returns np.array engines x timestamps
+        """
+        k, vs = self.oph_parameters(method)
+        ts = np.atleast_1d(np.asarray(ts, dtype=np.float64))
+        return np.maximum(k[:, np.newaxis] * (ts[np.newaxis, :] - vs[:, np.newaxis]), 0.0)
+
+    def batch_hist_dataItems(self, itemIds={161: 'CountOph'}, p_limit=None, p_from=None, p_to=None, timeCycle=86400,
+                             max_workers=8, raise_errors=False, **kwargs):
+        """
+        Get pandas dataFrame of dataItems history of all engines,
+        downloaded concurrently, either limit or From & to are required
+        dataItemIds         dict   e.g. {161: 'CountOph'}, dict of dataItems to query.
+        p_limit, p_from, p_to, timeCycle, kwargs: see Engine.batch_hist_dataItems
+        max_workers         int64  number of engines downloaded in parallel
+        raise_errors        bool   raise MyPlantException if an engine failed
+
+        returns long format DataFrame, columns serialNumber, time, dataItem, value
+        failed engines are reported in df.attrs['failures'] {serialNumber: error}
+        """
+        def fetch(e):
+            df = e.batch_hist_dataItems(itemIds, p_limit=p_limit, p_from=p_from, p_to=p_to,
+                                        timeCycle=timeCycle, **kwargs)
+            if df is None:
+                raise MyPlantException(f'{e._sn}: no data received')
+            return df
+
+        with ThreadPoolExecutor(max_workers=max_workers) as ex:
+            futures = [(e, ex.submit(contextvars.copy_context().run, fetch, e))
+                       for e in self._engines]
+
+        frames = []
+        failures = {}
+        for e, future in futures:
+            try:
+                df = future.result()
+            except Exception as err:
+                logging.error(f'{e._sn} {e.Name}: {err}')
+                failures[e._sn] = repr(err)
+                continue
+            df = df.melt(id_vars='time', var_name='dataItem', value_name='value')
+            df.insert(0, 'serialNumber', e._sn)
+            frames.append(df)
+
+        if failures and raise_errors:
+            raise MyPlantException(
+                f'{len(failures)} of {len(self._engines)} engines failed: {failures}')
+        columns = ['serialNumber', 'time', 'dataItem', 'value']
+        ldf = pd.concat(frames, ignore_index=True)[columns] if frames else pd.DataFrame(columns=columns)
+        ldf.attrs['failures'] = failures
+        return ldf
+
     def eng_name(self, name):
         """
         Return the Engines containing Name Validation
@@ -5,6 +5,14 @@ from datetime import datetime as dt
 import json
 import os
 import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+try:
+    import fcntl
+    msvcrt = None
+except ImportError:     # Windows
+    import msvcrt
 
 period = 31*24*60*60
 
@@ -50,3 +58,95 @@ def cred():
     else:
         cred = getCredentials()
         saveCredentials(cred)
+
+
+@contextmanager
+def atomic_write(fname, mode='w', encoding='utf-8'):
+    """
+    file object writing to a temp file in the directory of fname,
+    renamed to fname when the with block ends without error.
+    Readers see either the old or the new file, never a partial one.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fname)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode, encoding=None if 'b' in mode else encoding) as handle:
+            yield handle
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(tmp, fname)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class FileLock(object):
+    """
+    exclusive lock between processes on a lock file, reentrant
+    within a thread, other threads of the process wait as well.
+    Blocks until the lock is free.
+    e.g.:
+        with FileLock('./data/1234.lock'):
+            ...
+    """
+
+    def __init__(self, fname):
+        self._fname = fname
+        self._lock = threading.RLock()
+        self._count = 0
+        self._handle = None
+
+    def _lock_file(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self._fname)), exist_ok=True)
+        handle = open(self._fname, 'a+b')
+        try:
+            if msvcrt is not None:
+                handle.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(handle.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        pass    # LK_LOCK gives up after 10 seconds, retry
+            else:
+                fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+        except:
+            handle.close()
+            raise
+        return handle
+
+    def _unlock_file(self, handle):
+        try:
+            if msvcrt is not None:
+                handle.seek(0)
+                msvcrt.locking(handle.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+        finally:
+            handle.close()
+
+    def acquire(self):
+        self._lock.acquire()
+        try:
+            if self._count == 0:
+                self._handle = self._lock_file()
+        except:
+            self._lock.release()
+            raise
+        self._count += 1
+        return self
+
+    def release(self):
+        try:
+            self._count -= 1
+            if self._count == 0:
+                handle, self._handle = self._handle, None
+                self._unlock_file(handle)
+        finally:
+            self._lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
@@ -0,0 +1,141 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.stats import chi2
+
+from dmyplant2.dEngine import Engine
+from dmyplant2.dValidation import Validation
+from dmyplant2.dReliability import (
+    FailureIndex, demonstrated_reliability_sr, demonstrated_reliability_grid,
+    demonstrated_reliability_mc)
+
+START, END = 1.575e9, 1.65e9
+
+
+class FakeEngine(Engine):
+    """Engine with the oph line parameters only, oph/oph2 are the real ones"""
+
+    Cylinders = None
+
+    def __init__(self, k, valstart_ts, cylinders):
+        self._k = k
+        self._k2 = k * 1.1
+        self._valstart_ts = valstart_ts
+        self.Cylinders = cylinders
+
+
+class FakeValidation(Validation):
+    """Validation of FakeEngines, oph_matrix is the real one"""
+
+    def __init__(self, n, seed):
+        rng = np.random.default_rng(seed)
+        self._engines = [FakeEngine(rng.uniform(0.5e-3, 1.2e-3),
+                                    1.58e9 + rng.uniform(0, 3e7),
+                                    int(rng.choice([12, 16, 20, 24]))) for _ in range(n)]
+
+
+def reference_failures(t_arr, ft):
+    """the original failures loop"""
+    f_arr = np.zeros(len(t_arr))
+    if not(ft.empty):
+        for row in ft.values:
+            f_arr += np.where(t_arr > row[0].timestamp(), row[1], 0)
+    return f_arr
+
+
+def reference_sr(val, start, end, beta=1.21, CL=0.9, T=30000, ft=pd.DataFrame(), size=10):
+    """the original demonstrated_reliability_sr, one time point after the other"""
+    t_arr = np.linspace(start, end, size)
+    f_arr = reference_failures(t_arr, ft)
+    dr_arr = []
+    m = np.array([e.Cylinders for e in val.engines])
+    for i, t in enumerate(t_arr):
+        tt = np.array([e.oph(t) for e in val.engines])
+        tt_max = max(tt)
+        if tt_max > 0.0:
+            n_lip = sum(m*(tt/tt_max) ** beta)
+            n_lip_T = n_lip * ((tt_max/T) ** beta)
+            dr_arr.append(np.exp(-chi2.ppf(CL, 2*(f_arr[i]+1))/(2*n_lip_T)) * 100.0)
+        else:
+            dr_arr.append(0.0)
+    return (t_arr, np.array(dr_arr), f_arr)
+
+
+FAILURES = pd.DataFrame({
+    'date': pd.to_datetime(['2021-03-01', '2020-09-01', '2020-12-01', '2021-03-01']),
+    'failures': [1, 2, 1, 3]})
+NO_FAILURES = pd.DataFrame()
+
+
+@pytest.fixture(scope='module', params=[(5, 1), (40, 2)], ids=['5 engines', '40 engines'])
+def val(request):
+    return FakeValidation(*request.param)
+
+
+@pytest.mark.parametrize('method', ['oph', 'oph2'])
+@pytest.mark.parametrize('size', [1, 10, 1000])
+def test_oph_matrix_equals_engine_oph(val, method, size):
+    ts = np.linspace(START, END, size)
+    oph = val.oph_matrix(ts, method=method)
+    assert oph.shape == (len(val.engines), size)
+    for e, row in zip(val.engines, oph):
+        np.testing.assert_array_equal(row, getattr(e, method)(ts))
+        np.testing.assert_array_equal(row, [getattr(e, method)(t) for t in ts])
+    assert isinstance(val.engines[0].oph(START), float)
+
+
+@pytest.mark.parametrize('size', [10, 1000])
+@pytest.mark.parametrize('ft', [FAILURES, NO_FAILURES], ids=['failures', 'no failures'])
+@pytest.mark.parametrize('beta, CL, T', [(1.21, 0.9, 30000), (0.8, 0.6, 24000)])
+def test_sr_equals_reference(val, size, ft, beta, CL, T):
+    expected = reference_sr(val, START, END, beta=beta, CL=CL, T=T, ft=ft, size=size)
+    result = demonstrated_reliability_sr(val, START, END, beta=beta, CL=CL, T=T, ft=ft, size=size)
+    for r, e in zip(result, expected):
+        assert r.dtype == e.dtype
+        np.testing.assert_array_equal(r, e)
+
+
+@pytest.mark.parametrize('size', [10, 1000])
+@pytest.mark.parametrize('ft', [FAILURES, NO_FAILURES], ids=['failures', 'no failures'])
+def test_grid_rows_equal_sr(val, size, ft):
+    betas, Ts, cls = [0.8, 1.21], [24000, 30000], [0.1, 0.5, 0.9]
+    t_arr, dr, f_arr = demonstrated_reliability_grid(
+        val, START, END, beta=betas, CL=cls, T=Ts, ft=ft, size=size)
+    assert len(dr) == len(betas) * len(Ts) * len(cls)
+    for beta in betas:
+        for T in Ts:
+            for CL in cls:
+                t, r, f = demonstrated_reliability_sr(val, START, END, beta=beta, CL=CL, T=T, ft=ft, size=size)
+                np.testing.assert_array_equal(dr.loc[(beta, T, CL)].values, r)
+                np.testing.assert_array_equal(t_arr, t)
+                np.testing.assert_array_equal(f_arr, f)
+
+
+@pytest.mark.parametrize('size', [10, 1000])
+@pytest.mark.parametrize('ft', [FAILURES, NO_FAILURES], ids=['failures', 'no failures'])
+def test_failure_index_equals_reference(size, ft):
+    t_arr = np.linspace(START, END, size)
+    # failures exactly on a time point are not counted there
+    t_arr = np.concatenate([t_arr, [d.timestamp() for d in FAILURES['date']]])
+    np.testing.assert_array_equal(FailureIndex(ft).count(t_arr), reference_failures(t_arr, ft))
+
+
+def test_failure_index_as_ft(val):
+    fi = FailureIndex(FAILURES)
+    assert fi.total == FAILURES['failures'].sum()
+    for r, e in zip(demonstrated_reliability_sr(val, START, END, ft=fi, size=100),
+                    demonstrated_reliability_sr(val, START, END, ft=FAILURES, size=100)):
+        np.testing.assert_array_equal(r, e)
+
+
+@pytest.mark.parametrize('size', [10, 1000])
+@pytest.mark.parametrize('ft', [FAILURES, NO_FAILURES], ids=['failures', 'no failures'])
+def test_mc_independent_of_workers(size, ft):
+    val = FakeValidation(5, 1)
+    kwargs = dict(ft=ft, size=size, samples=200, block=50, seed=42)
+    t1, b1, f1 = demonstrated_reliability_mc(val, START, END, max_workers=1, **kwargs)
+    t2, b2, f2 = demonstrated_reliability_mc(val, START, END, max_workers=2, **kwargs)
+    np.testing.assert_array_equal(b1.values, b2.values)
+    np.testing.assert_array_equal(f1, f2)
+    assert list(b1.index) == [5, 50, 95]
+    assert (b1.loc[5] <= b1.loc[95]).all()
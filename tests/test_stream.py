@@ -0,0 +1,90 @@
+import json
+import numpy as np
+import pandas as pd
+import pytest
+
+from dmyplant2.dServer import synthetic
+from dmyplant2.dStream import BatchDataDecoder
+
+ITEMS = {161: 'CountOph', 102: 'Power', 217: 'Speed'}
+URL = ('/asset/100001/history/batchdata?assetType=J-Engine&from=1577836800000&to=1580428800000'
+       '&dataItemIds=161,102,217&timeCycle=3600&includeMinMax=false&forceDownSampling=false')
+
+
+def decode(raw, chunk=65536, expected=1024):
+    dec = BatchDataDecoder(expected=expected)
+    for i in range(0, len(raw), chunk):
+        dec.feed(raw[i:i + chunk])
+    dec.close()
+    return dec
+
+
+def reference_frame(data, itemIds):
+    """the list of lists path of Engine.batch_hist_dataItems(stream=False)"""
+    labels = ['time'] + [itemIds[x] for x in data['columns'][1]]
+    return pd.DataFrame([[r[0]] + [rr[0] for rr in r[1]] for r in data['data']], columns=labels)
+
+
+@pytest.mark.parametrize('chunk', [1, 7, 65536])
+@pytest.mark.parametrize('expected', [16, 100000])
+def test_synthetic_equals_reference(chunk, expected):
+    data = synthetic(URL)
+    df = decode(json.dumps(data).encode('utf-8'), chunk=chunk, expected=expected).frame(ITEMS)
+    assert len(df) == len(data['data']) > 16
+    pd.testing.assert_frame_equal(df, reference_frame(data, ITEMS))
+
+
+def test_numbers_split_across_chunks():
+    dec = BatchDataDecoder()
+    for chunk in (b'{"columns": [["time"], [1, 2]], "data": [[1000', b'0, [[12', b'.5', b'e1], [-',
+                  b'3]]]]', b'}'):
+        dec.feed(chunk)
+    dec.close()
+    np.testing.assert_array_equal(dec.times, [10000])
+    np.testing.assert_array_equal(dec.values, [[125.0, -3.0]])
+
+
+def test_integer_items_are_float64():
+    raw = b'{"columns": [["time"], [1]], "data": [[1000, [[1]]], [2000, [[2]]]]}'
+    df = decode(raw, chunk=1).frame({1: 'a'})
+    assert df['a'].dtype == np.float64
+    assert df['time'].dtype == np.int64
+    np.testing.assert_array_equal(df['a'], [1.0, 2.0])
+
+
+def test_data_before_columns():
+    raw = b'{"data": [[1000, [[1.5], [2.5]]]], "other": {"x": [1]}, "columns": [["time"], [1, 2]]}'
+    dec = decode(raw, chunk=3)
+    assert dec.columns == [['time'], [1, 2]]
+    pd.testing.assert_frame_equal(dec.frame({1: 'a', 2: 'b'}),
+                                  pd.DataFrame({'time': [1000], 'a': [1.5], 'b': [2.5]}))
+
+
+def test_null_and_empty_items():
+    raw = b'{"columns": [["time"], [1, 2]], "data": [[1000, [[], [null]]], [2000, [[1.0], []]]]}'
+    values = decode(raw, chunk=1).values
+    assert values.dtype == np.float64
+    np.testing.assert_array_equal(values, [[np.nan, np.nan], [1.0, np.nan]])
+
+
+@pytest.mark.parametrize('data', [b'null', b'[]'])
+def test_no_data(data):
+    raw = b'{"columns": [["time"], [1, 2]], "data": ' + data + b'}'
+    df = decode(raw, chunk=1).frame({1: 'a', 2: 'b'})
+    assert list(df.columns) == ['time', 'a', 'b']
+    assert len(df) == 0
+
+
+def test_strings_fall_back_to_object():
+    raw = '{"columns": [["time"], [1, 2]], "data": [[1000, [[1.5], [2]]], [2000, [["Zündung"], [3]]]]}'
+    values = decode(raw.encode('utf-8'), chunk=1).values
+    assert values.dtype == object
+    assert list(values[:, 0]) == [1.5, 'Zündung']
+    assert list(values[:, 1]) == [2.0, 3.0]
+
+
+def test_incomplete_response():
+    dec = BatchDataDecoder()
+    dec.feed(b'{"columns": [["time"], [1]], "data": [[1000, [[1.0]]]')
+    with pytest.raises(ValueError):
+        dec.close()